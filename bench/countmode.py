@@ -0,0 +1,53 @@
+# Benchmark der COUNTMODEs gegen einen Solr mit GVI Index: dieselbe
+# gruppierte Anfrage wie /json, einmal je Zaehlweise. Ausgegeben werden
+# Solr QTime und Gesamtzeit (Median) und die gelieferte Trefferzahl.
+# 'cached' kostet ab der zweiten Seite einer Anfrage nichts (TOTAL_CACHE),
+# die erste Seite wie 'cardinality'.
+#
+# Aufruf: python bench/countmode.py SOLR_URL [runden] [primo-anfrage ...]
+# z.B.    python bench/countmode.py http://gvi.bsz-bw.de/solr/GVIPROD 10 "any,contains,goethe faust"
+
+import os, statistics, sys, time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+import gvi2pnx
+
+QUERIES = ['any,contains,geschichte', 'any,contains,goethe faust', 'title,contains,zeitschrift fuer physik']
+MODES   = ['cardinality', 'ngroups', 'numfound']
+
+
+def run(solr, query, countmode, rounds):
+    (_query, _facetquery, _sort, _from, _bulksize) = gvi2pnx.rewrite_parameters(
+        query, list(gvi2pnx.JSON_FILTERS), 'rank', '1', '10')
+    qtimes = []
+    walls  = []
+    total  = None
+    for i in range(rounds):
+        plan  = gvi2pnx.SubRequests(gvi2pnx.SOLR_TIMEOUT_JSON)
+        start = time.perf_counter()
+        results = gvi2pnx.search_groups(solr, _query, _facetquery, _sort, _from, _bulksize,
+                                        ','.join(gvi2pnx.JSON_GROUP_FIELDS), countmode, plan)
+        walls.append((time.perf_counter() - start) * 1000)
+        qtimes.append(results.qtime or 0)
+        total = gvi2pnx.count_total(results, countmode)
+    return (statistics.median(qtimes), statistics.median(walls), total)
+
+
+def main():
+    if len(sys.argv) < 2:
+        sys.exit('usage: countmode.py SOLR_URL [rounds] [query ...]')
+    url     = sys.argv[1]
+    rounds  = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    queries = sys.argv[3:] or QUERIES
+    solr = gvi2pnx.SOLR_POOL.get(url, gvi2pnx.SOLR_TIMEOUT_JSON, gvi2pnx.SOLR_POOLSIZE)
+    print('median of %s rounds, %s' % (rounds, url))
+    for query in queries:
+        print(query)
+        for countmode in MODES:
+            (qtime, wall, total) = run(solr, query, countmode, rounds)
+            print('  %-12s QTime %6.0f ms   total %7.1f ms   info.total %s' % (countmode, qtime, wall, total))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+# Benchmark der /json Serialisierung: eingerueckt und sortiert (DEBUG,
+# pretty=true), kompakt mit json und kompakt mit orjson (wenn
+# installiert) fuer eine Seite PNX Dokumente aus dem MARCXML Korpus.
+#
+# Aufruf: python bench/dump_json.py [bulksize] [runden]
+
+import json, os, sys, time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+import gvi2pnx
+
+CORPUS = os.path.join(os.path.dirname(HERE), 'tests', 'data', 'marcxml.jsonl')
+
+
+def page(bulksize):
+    # R wie search_json: info, facets, docs
+    with open(CORPUS, encoding='utf-8') as f:
+        docs = [json.loads(line) for line in f if line.strip()]
+    pnx_docs = []
+    for i in range(bulksize):
+        doc = docs[i % len(docs)]
+        gid = doc["id"]
+        sourcesystem = gid[1:3] + gid[4:7]
+        record = gvi2pnx.parse_marcxml(doc["fullrecord"], gvi2pnx.PNX_TAGS)
+        pnx_docs.append(gvi2pnx.marc_to_pnx(
+            gid, gid[8:], sourcesystem, "%s_%s" % (sourcesystem, gid[8:]),
+            doc["material_content_type"][0].lower(), 'ger', ['DE-576', gid, 'DE-180'], 'Structured Metadata',
+            [('https://portal.kobv.de/uid.do?index=gvi&query=%s', 'KOBV-Portal')], [], [], [], record, False))
+    facets = gvi2pnx.empty_facets()
+    for facet in facets:
+        facet["values"] = [{ "count":1000 - n, "value":"Wert %s" % n } for n in range(10)]
+    return { "info":{ "total":12345, "last":bulksize, "first":1 }, "facets":facets, "docs":pnx_docs }
+
+def best(fn, rounds):
+    times = []
+    for i in range(rounds):
+        start = time.perf_counter()
+        body = fn()
+        times.append(time.perf_counter() - start)
+    return (body, min(times) * 1e6)
+
+
+def main():
+    bulksize = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    rounds   = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    R = page(bulksize)
+    print('%s PNX documents, best of %s rounds' % (bulksize, rounds))
+    (pretty, t) = best(lambda: gvi2pnx.dump_json(R, True), rounds)
+    print('  indent=2, sort_keys  %7s bytes  %7.0f us' % (len(pretty), t))
+    (compact, t) = best(lambda: json.dumps(R, ensure_ascii=False, separators=(',', ':')).encode('utf-8'), rounds)
+    print('  compact json         %7s bytes  %7.0f us' % (len(compact), t))
+    if gvi2pnx.orjson is None:
+        print('  compact orjson       (orjson not installed)')
+        return
+    (fast, t) = best(lambda: gvi2pnx.orjson.dumps(R), rounds)
+    print('  compact orjson       %7s bytes  %7.0f us  (%s)' % (len(fast), t,
+          'identical bytes' if fast == compact else 'bytes differ'))
+
+
+if __name__ == '__main__':
+    main()
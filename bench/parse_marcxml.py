@@ -0,0 +1,52 @@
+# Mikro-Benchmark: MARCXML eines Solr fullrecord parsen, bisher mit
+# pymarc.parse_xml_to_array (SAX), jetzt mit parse_marcxml (ElementTree),
+# einmal mit allen Datenfeldern (/plain) und einmal nur PNX_TAGS (/json).
+#
+# Aufruf: python bench/parse_marcxml.py [korpus.jsonl] [runden]
+# Korpus: eine JSON Zeile pro Datensatz mit "fullrecord", Vorgabe ist
+# tests/data/marcxml.jsonl
+
+import io, json, os, sys, time
+
+from pymarc import parse_xml_to_array
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+import gvi2pnx
+
+
+def load(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line)["fullrecord"] for line in f if line.strip()]
+
+def best(fn, records, rounds):
+    # beste Runde, Mikrosekunden pro Datensatz
+    times = []
+    for i in range(rounds):
+        start = time.perf_counter()
+        for marcxml in records:
+            fn(marcxml)
+        times.append(time.perf_counter() - start)
+    return min(times) / len(records) * 1e6
+
+
+def main():
+    path   = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(HERE), 'tests', 'data', 'marcxml.jsonl')
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    records = load(path)
+    for marcxml in records:
+        old = parse_xml_to_array(io.StringIO(marcxml))[0]
+        if gvi2pnx.parse_marcxml(marcxml).as_dict() != old.as_dict():
+            sys.exit('parse_marcxml differs from parse_xml_to_array')
+    size = sum(len(marcxml) for marcxml in records) / len(records)
+    print('%s records, avg. %.1f KB, best of %s rounds' % (len(records), size / 1024, rounds))
+    sax  = best(lambda marcxml: parse_xml_to_array(io.StringIO(marcxml))[0], records, rounds)
+    full = best(gvi2pnx.parse_marcxml, records, rounds)
+    pnx  = best(lambda marcxml: gvi2pnx.parse_marcxml(marcxml, gvi2pnx.PNX_TAGS), records, rounds)
+    print('  parse_xml_to_array(io.StringIO(...))  %7.0f us/record' % sax)
+    print('  parse_marcxml(...)                    %7.0f us/record  (%.1fx)' % (full, sax / full))
+    print('  parse_marcxml(..., PNX_TAGS)          %7.0f us/record  (%.1fx)' % (pnx, sax / pnx))
+
+
+if __name__ == '__main__':
+    main()
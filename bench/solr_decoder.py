@@ -0,0 +1,74 @@
+# Benchmark der Decoder fuer Solr Antworten (SOLR_DECODER): json gegen
+# orjson. Ohne Argumente mit einer gruppierten Antwort wie bei /json
+# (50 Gruppen x 10 Dokumente mit fullrecord aus dem MARCXML Korpus) und
+# einer reinen Facetten-Antwort; sonst mit aufgezeichneten Solr
+# Antworten (wt=json) aus den angegebenen Dateien.
+#
+# Aufruf: python bench/solr_decoder.py [antwort.json ...]
+
+import json, os, sys, time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+import gvi2pnx
+
+CORPUS = os.path.join(os.path.dirname(HERE), 'tests', 'data', 'marcxml.jsonl')
+ROUNDS = 5
+CALLS  = 50
+
+
+def grouped_response():
+    with open(CORPUS, encoding='utf-8') as f:
+        docs = [json.loads(line) for line in f if line.strip()]
+    groups = []
+    for g in range(50):
+        doclist = []
+        for d in range(10):
+            doc = dict(docs[(g * 10 + d) % len(docs)])
+            doc.update(consortium=['DE-576'], institution_id=['DE-180', 'DE-19'], language=['ger'])
+            doclist.append(doc)
+        groups.append({ "groupValue":"key%s" % g, "doclist":{ "numFound":10, "start":0, "docs":doclist } })
+    return json.dumps({ "responseHeader":{ "status":0, "QTime":12 },
+                        "grouped":{ "test_matchkey_3":{ "matches":5000, "groups":groups } },
+                        "stats":{ "stats_fields":{ "test_matchkey_3":{ "cardinality":4200 } } } })
+
+def facet_response():
+    fields = dict((field, sum([["Wert %s" % n, 1000 - n] for n in range(10)], []))
+                  for field in ['author_facet', 'material_access', 'material_content_type',
+                                'language', 'subject_all_facet', 'consortium'])
+    return json.dumps({ "responseHeader":{ "status":0, "QTime":3 },
+                        "response":{ "numFound":5000, "start":0, "docs":[] },
+                        "facet_counts":{ "facet_queries":{}, "facet_fields":fields } })
+
+def best(decoder, text):
+    times = []
+    for i in range(ROUNDS):
+        start = time.perf_counter()
+        for j in range(CALLS):
+            decoder.decode(text)
+        times.append((time.perf_counter() - start) / CALLS)
+    return min(times) * 1000
+
+
+def main():
+    responses = [('grouped, 50 groups x 10 docs with fullrecord', grouped_response()),
+                 ('facets only (rows=0)', facet_response())]
+    if len(sys.argv) > 1:
+        responses = []
+        for path in sys.argv[1:]:
+            with open(path, encoding='utf-8') as f:
+                responses.append((path, f.read()))
+    print('best of %sx%s runs' % (ROUNDS, CALLS))
+    for (name, text) in responses:
+        line = '  json %.2f ms' % best(json.JSONDecoder(), text)
+        if gvi2pnx.orjson is not None:
+            same = gvi2pnx.OrjsonDecoder().decode(text) == json.loads(text)
+            line = line + '   orjson %.2f ms%s' % (best(gvi2pnx.OrjsonDecoder(), text), '' if same else '  (result differs)')
+        else:
+            line = line + '   (orjson not installed)'
+        print('%s (%.0f KB)' % (name, len(text) / 1024))
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
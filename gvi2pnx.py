@@ -1,9 +1,22 @@
-from flask import Flask, make_response, request
-from pymarc import Record, Field, parse_xml_to_array
+from flask import Flask, make_response, request, Response, stream_with_context
+from pymarc import Record, Field, Subfield, Indicators, Leader
 from urllib.parse import urlencode
 import pysolr, pymarc, io, json, sys, re, traceback, datetime
+import gzip, zlib
+import requests
+import os, signal, threading, time, collections
+import concurrent.futures
 import logging
 import configparser
+import xml.etree.ElementTree as ET
+try:
+    import orjson                       # optional, schnellere JSON Ausgabe
+except ImportError:
+    orjson = None
+try:
+    import brotli                       # optional, Content-Encoding br
+except ImportError:
+    brotli = None
 
 
 #logging.basicConfig(filename='example.log', encoding='utf-8', level=logging.DEBUG)
@@ -11,140 +24,921 @@ import configparser
 #logging.basicConfig(qualname='primogvi')
 
 GVIURL     = 'http://gvi.bsz-bw.de/solr/GVIPROD'
+SOLR_TIMEOUT_JSON  = 30   # Sekunden
+SOLR_TIMEOUT_PLAIN = 10
+SOLR_POOLSIZE      = 10   # keep-alive Verbindungen pro Solr URL
+SOLR_DECODER       = 'orjson'   # JSON der Solr Antworten: 'orjson' (wenn installiert) oder 'json'
+
+RESPONSE_CACHE_TTL     = 300                # Sekunden, CACHETTL im Mandanten, 0 = aus
+RESPONSE_CACHE_ENTRIES = 2000
+RESPONSE_CACHE_BYTES   = 64 * 1024 * 1024
+PNX_CACHE_TTL          = 3600               # Sekunden
+PNX_CACHE_ENTRIES      = 20000
+
+# Dublettenbereinigung, DEDUP im Mandanten: 'group' (group=true) oder
+# 'collapse' ({!collapse} mit expand fuer die Bestaende der Dubletten).
+# Titel ohne test_matchkey_3 bleiben beim collapse einzeln erhalten
+# (nullPolicy=expand), sonst fielen sie aus der Trefferliste.
+DEDUP = 'group'
+DEDUP_MODES  = ['group', 'collapse']
+COLLAPSE_FQ  = '{!collapse field=test_matchkey_3 nullPolicy=expand}'
+
+# Trefferzahl bei DEDUP 'group', COUNTMODE im Mandanten:
+#   cardinality  HyperLogLog ueber test_matchkey_3 (Gruppen, geschaetzt)
+#   ngroups      group.ngroups (Gruppen, exakt, teuer bei vielen Treffern)
+#   numfound     Anzahl Treffer ohne Dublettenbereinigung (kostenlos)
+#   cached       cardinality fuer die erste Seite, danach aus TOTAL_CACHE
+COUNTMODE = 'cardinality'
+COUNT_PARAMS = {
+    'cardinality': { 'group.ngroups': 'false',
+                     'stats': 'true',
+                     'stats.field': '{!cardinality=true}test_matchkey_3' },
+    'ngroups':     { 'group.ngroups': 'true' },
+    'numfound':    { 'group.ngroups': 'false' },
+    }
+
+FACET_CACHE_TTL        = 600               # Sekunden
+FACET_CACHE_ENTRIES    = 5000
+
+SOLR_THREADS           = 16                # parallele Solr Teilanfragen pro Worker
+SOLR_DEADLINE          = 20                # Sekunden pro /json Anfrage, DEADLINE im Mandanten,
+                                           # kuerzer per Parameter deadline; Solr erhaelt den Rest als timeAllowed
+SOLR_DEADLINE_MARGIN   = 0.2               # Sekunden (mindestens, sonst 10% der Restzeit), die timeAllowed vor
+                                           # der Deadline endet: Zeit fuer Uebertragung der partialResults
+
+# Vorab-Laden der naechsten Seite, PREFETCH = True im Mandanten
+PREFETCH_THREADS       = 2                 # gleichzeitige Prefetches pro Worker
+PREFETCH_PER_MINUTE    = 60                # Budget pro Worker
+PREFETCH_MAX_LATENCY   = 2.0               # Sekunden Solr Antwortzeit (EWMA), darueber kein Prefetch
+PREFETCH_DEADLINE      = 5                 # Sekunden pro Prefetch, danach bricht Solr ab (timeAllowed)
+
+BATCH_MAX_IDS          = 500               # ids pro /json/batch Anfrage
+
+# Kompression von /json und /plain nach Accept-Encoding (br nur mit brotli)
+COMPRESS_MIN_SIZE      = 1024              # Bytes, kleinere Antworten unkomprimiert
+GZIP_LEVEL             = 6
+BROTLI_QUALITY         = 5
+EXPORT_ROWS            = 100               # Treffer pro Solr Anfrage bei /json/export
+
+# Replicas, GVIURLS im Mandanten (eine URL pro Zeile)
+HEDGE_DELAY            = 0.5               # Sekunden bis zur Zweitanfrage, solange kein p95 vorliegt
+HEDGE_MIN_DELAY        = 0.05
+REPLICA_WINDOW         = 100               # Antwortzeiten fuer das p95 pro Replica
+REPLICA_FAILURE_WINDOW = 30                # Sekunden, ueber die die Fehlerquote gemessen wird
+REPLICA_MIN_REQUESTS   = 5                 # Anfragen im Fenster, bevor gesperrt werden kann
+REPLICA_FAILURE_RATE   = 0.5               # Fehlerquote im Fenster bis zur Sperre
+REPLICA_RETRY          = 30                # Sekunden Sperre, danach ein Versuch
+HEDGE_MAX_INFLIGHT     = SOLR_THREADS      # laufende Replica Anfragen, darueber keine Zweitanfragen
+
+# Foederierte Suche, CORES im Mandanten: weitere Solr Cores (eine URL pro
+# Zeile), die zusaetzlich zu GVIURL(S) parallel abgefragt werden
+FEDERATED_MAX_ROWS     = 500               # Gruppen pro Core (from + bulksize)
+
+# FETCHMODE im Mandanten: 'grouped' (fullrecord in der Gruppierung) oder
+# 'twophase' (Gruppierung mit JSON_GROUP_FIELDS, fullrecords nachladen)
+FETCHMODE         = 'grouped'
+
+# Solr Felder, die do_json und do_plain auswerten (statt fl='*,score');
+# FIELDS im Mandanten ergaenzt weitere Felder
+JSON_GROUP_FIELDS = ['id', 'consortium', 'institution_id', 'material_content_type', 'language']
+JSON_FIELDS       = JSON_GROUP_FIELDS + ['fullrecord']
+PLAIN_FIELDS      = ['id', 'institution_id', 'material_content_type', 'fullrecord']
 CONFIGFILE = 'gvi2pnx.ini' 
+CONFIG_CHECK_INTERVAL = 1.0
 FLAG       = False
 
 class Config:
     
-    def __init__(self, token):
+    def __init__(self, config=None, section=None):
         self._debug       = False
-        self._section     = None
+        self._section     = section
         self._token       = None
         self._isil        = None
         self._gviurl      = None
+        self._gviurls     = []
+        self._cores       = []
+        self._timeout     = None
+        self._poolsize    = None
+        self._cachettl    = None
+        self._fetchmode   = FETCHMODE
+        self._fields      = []
+        self._deadline    = None
+        self._countmode   = COUNTMODE
+        self._dedup       = DEDUP
+        self._prefetch    = False
         self._delcategory = "Remote Search Resource"
-        self._config = configparser.ConfigParser()
-        self._config.read(CONFIGFILE)
-        for section in self._config.sections():
-            if self._config[section]['TOKEN'] == token:
-                self._section = section
-                self._token   = token
-                try:
-                    self._gviurl = self._config[section]['GVIURL']
-                except:
-                    pass
-                try:
-                    self._isil = self._config[section]['ISIL']
-                except:
-                    pass
-                try:
-                    self._delcategory = self._config[section]['DELCATEGORY']
-                except:
-                    pass
-                try:
-                    if self._config[section]['DEBUG'] == "True":
-                        self._debug = True 
-                        Log('Set Debug Flag to "True"')
-                    else:
-                        Log('Set Debug Flag to "False"')
-                except:
-                    Log('Debug Flag ignored')
-                    pass
+        self._links       = []
+        self._openurls    = []
+        self._baseurls    = []
+        self._isils       = []
+        self._filters     = []
+        if section is None:
+            return
+        values = config[section]
+        self._token       = get_value(values, 'TOKEN')
+        self._gviurl      = get_value(values, 'GVIURL')
+        self._gviurls     = get_value(values, 'GVIURLS', '').split()
+        self._cores       = get_value(values, 'CORES', '').split()
+        self._timeout     = get_number(values, 'SOLRTIMEOUT', float)
+        self._poolsize    = get_number(values, 'SOLRPOOLSIZE', int)
+        self._cachettl    = get_number(values, 'CACHETTL', float)
+        self._fetchmode   = get_value(values, 'FETCHMODE', FETCHMODE)
+        self._fields      = get_value(values, 'FIELDS', '').split()
+        self._deadline    = get_number(values, 'DEADLINE', float)
+        self._countmode   = get_value(values, 'COUNTMODE', COUNTMODE)
+        self._dedup       = get_value(values, 'DEDUP', DEDUP)
+        self._prefetch    = get_value(values, 'PREFETCH') == "True"
+        if self._countmode not in COUNT_PARAMS and self._countmode != 'cached':
+            Log('Unknown COUNTMODE %s in %s', self._countmode, section, level=logging.WARNING)
+            self._countmode = COUNTMODE
+        if self._dedup not in DEDUP_MODES:
+            Log('Unknown DEDUP %s in %s', self._dedup, section, level=logging.WARNING)
+            self._dedup = DEDUP
+        self._isil        = get_value(values, 'ISIL')
+        self._delcategory = get_value(values, 'DELCATEGORY', self._delcategory)
+        if get_value(values, 'DEBUG') == "True":
+            self._debug = True
+        for (link, text) in split_templates(get_value(values, 'LINKS')):
+            if self._debug==True or (self._debug==False and 'debug' not in text.lower()):
+                self._links.append((link,text))
+        self._openurls = split_templates(get_value(values, 'OPENURLS'))
+        self._baseurls = split_templates(get_value(values, 'BASEURLS'))
+        self._isils    = split_templates(get_value(values, 'ISILS'))
+        if get_value(values, 'FILTERS') is not None:
+            self._filters = get_value(values, 'FILTERS').split("\n")
+        Log('Config Section %s: Debug=%s Links=%s OpenURLs=%s BaseURLs=%s Isils=%s Filters=%s',
+            section, self._debug, self._links, self._openurls, self._baseurls, self._isils, self._filters)
                     
     def get_delcategory(self):
         return self._delcategory
     
     def validate(self, token):
-        Log("validating %s" % token)
+        Log("validating %s", token)
         if self._token is None:
             return False
         return token == self._token
         
     def get_links(self):
-        Log('Config Section: %s' % self._section)
-        list = []
-        if self._section is not None:
-            try:
-                for element in self._config[self._section]['LINKS'].split("\n"):
-                    Log('Element: %s' % element)
-                    link, text = element.split(maxsplit=1)
-                    Log('Split:   "%s" "%s"' % (link, text) )
-                    if self._debug==True or (self._debug==False and 'debug' not in text.lower()):
-                        Log('Append:   "%s" "%s"' % (link, text) )
-                        list.append((link,text))
-            except:
-                pass
-        Log('Link Templates: %s' % list)
-        return list
+        return self._links
 
     def get_openurls(self):
-        Log('Config Section: %s' % self._section)
-        list = []
-        if self._section is not None:
-            try:
-                for element in self._config[self._section]['OPENURLS'].split("\n"):
-                    Log('Element: %s' % element)
-                    link, text = element.split(maxsplit=1)
-                    Log('Split:   "%s" "%s"' % (link, text) )
-                    list.append((link,text))
-            except:
-                pass
-        Log('OpenURL Templates: %s' % list)
-        return list
+        return self._openurls
 
     def get_baseurls(self):
-        Log('Config Section: %s' % self._section)
-        list = []
-        if self._section is not None:
-            try:
-                for element in self._config[self._section]['BASEURLS'].split("\n"):
-                    Log('Element: %s' % element)
-                    link, text = element.split(maxsplit=1)
-                    Log('Split:   "%s" "%s"' % (link, text) )
-                    list.append((link,text))
-            except:
-                pass
-        Log('OpenURL Templates: %s' % list)
-        return list
+        return self._baseurls
 
     def get_isils(self):
-        Log('Config Section: %s' % self._section)
-        list = []
-        if self._section is not None:
-            try:
-                for element in self._config[self._section]['ISILS'].split("\n"):
-                    Log('Element: %s' % element)
-                    isil, text = element.split(maxsplit=1)
-                    Log('Split:   "%s" "%s"' % (isil, text) )
-                    list.append((isil,text))
-            except:
-                pass
-        Log('Isil Templates: %s' % list)
-        return list
+        return self._isils
 
     def get_filters(self):
-        Log('Config Section: %s' % self._section)
-        list = []
-        if self._section is not None:
-            try:
-                for element in self._config[self._section]['FILTERS'].split("\n"):
-                    Log('Element: %s' % element)
-                    list.append(element)
-            except:
-                pass
-        Log('FILTERS Templates: %s' % list)
-        return list
+        return self._filters
         
     def get_isil(self):
-        Log('Config Section: %s' % self._section)
-        Log('Isil: %s' % self._isil)
         return self._isil
         
     def get_gviurl(self):
-        Log('Config Section: %s' % self._section)
-        Log('GVIURL: %s' % self._gviurl)
         return self._gviurl
 
+    def get_gviurls(self):
+        if self._gviurls == []:
+            return [self._gviurl or GVIURL]
+        return self._gviurls
+
+    def get_cores(self):
+        return self._cores
+
+    def get_timeout(self, default):
+        if self._timeout is None:
+            return default
+        return self._timeout
+
+    def get_poolsize(self):
+        if self._poolsize is None:
+            return SOLR_POOLSIZE
+        return self._poolsize
+
+    def get_fl(self, fields):
+        return ','.join(fields + [f for f in self._fields if f not in fields])
+
+    def get_deadline(self, requested=None):
+        # requested (Parameter deadline) kann die Deadline nur verkuerzen
+        deadline = SOLR_DEADLINE
+        if self._deadline is not None:
+            deadline = self._deadline
+        if requested is not None and 0 < requested < deadline:
+            return requested
+        return deadline
+
+    def get_prefetch(self):
+        return self._prefetch
+
+    def get_dedup(self):
+        return self._dedup
+
+    def get_countmode(self):
+        return self._countmode
+
+    def get_fetchmode(self):
+        return self._fetchmode
+
+    def get_cachettl(self):
+        if self._cachettl is None:
+            return RESPONSE_CACHE_TTL
+        return self._cachettl
+
+
+def get_value(values, key, default=None):
+    # ein fehlerhafter Wert (z.B. %-Interpolation) kostet nur diesen Schluessel
+    try:
+        return values.get(key, default)
+    except configparser.Error as e:
+        Log('Ignoring %s in %s: %s', key, values.name, e, level=logging.WARNING)
+        return default
+
+
+def get_number(values, key, type):
+    try:
+        return type(values[key])
+    except (KeyError, ValueError):
+        return None
+    except configparser.Error as e:
+        Log('Ignoring %s in %s: %s', key, values.name, e, level=logging.WARNING)
+        return None
+
+
+def split_templates(value):
+    # Mehrzeilige Werte "<url> <text>", Abbruch bei der ersten ungueltigen Zeile
+    list = []
+    if value is not None:
+        for element in value.split("\n"):
+            try:
+                link, text = element.split(maxsplit=1)
+            except ValueError:
+                break
+            list.append((link,text))
+    return list
+
+
+class ConfigCache:
+    # Token -> Config ueber alle Abschnitte von CONFIGFILE, einmal pro Worker
+    # gelesen. Neu geladen bei geaenderter mtime (hoechstens alle
+    # CONFIG_CHECK_INTERVAL Sekunden geprueft) oder nach SIGHUP; schlaegt das
+    # Laden fehl, bleibt der bisherige Index.
+    def __init__(self):
+        self._lock    = threading.Lock()
+        self._tokens  = {}
+        self._mtime   = None
+        self._checked = None
+        self._reload  = True
+        self._empty   = Config()
+
+    def request_reload(self):
+        self._reload = True
+
+    def get(self, token):
+        now = time.monotonic()
+        if self._checked is None or now - self._checked > CONFIG_CHECK_INTERVAL:
+            self._check(now)
+        return self._tokens.get(token, self._empty)
+
+    def _check(self, now):
+        with self._lock:
+            self._checked = now
+            try:
+                mtime = os.stat(CONFIGFILE).st_mtime
+            except OSError:
+                mtime = None
+            if not self._reload and mtime == self._mtime:
+                return
+            # _mtime und _reload erst nach erfolgreichem Laden setzen; sonst
+            # bleibt der bisherige Index und es wird nach dem Intervall neu
+            # versucht
+            try:
+                self._load()
+            except Exception as e:
+                Log('Loading config %s failed: %r', CONFIGFILE, e, level=logging.WARNING)
+                return
+            self._reload = False
+            self._mtime  = mtime
+
+    def _load(self):
+        Log('Loading config %s', CONFIGFILE, level=logging.INFO)
+        config = configparser.ConfigParser()
+        config.read(CONFIGFILE)
+        tokens = {}
+        for section in config.sections():
+            # ein fehlerhafter Abschnitt kostet nur diesen Mandanten
+            try:
+                token = get_value(config[section], 'TOKEN')
+                if token is not None:
+                    tokens[token] = Config(config, section)
+            except Exception as e:
+                Log('Ignoring config section %s: %r', section, e, level=logging.WARNING)
+        self._tokens = tokens
+        # gecachte Antworten haengen von den Templates der Mandanten ab
+        RESPONSE_CACHE.clear()
+        PNX_CACHE.clear()
+        FACET_CACHE.clear()
+        TOTAL_CACHE.clear()
+
+
+CONFIG_CACHE = ConfigCache()
+
+def get_config(token):
+    return CONFIG_CACHE.get(token)
+
+def _reload_config(signum, frame):
+    CONFIG_CACHE.request_reload()
+
+try:
+    signal.signal(signal.SIGHUP, _reload_config)
+except (AttributeError, ValueError):
+    # kein SIGHUP (Windows) oder Import ausserhalb des Main-Threads
+    pass
+
+class SolrPool:
+    # langlebige pysolr Clients pro (URL, timeout); pro URL eine
+    # requests.Session mit bis zu poolsize keep-alive Verbindungen
+    def __init__(self):
+        self._lock     = threading.Lock()
+        self._sessions = {}
+        self._clients  = {}
+        self.hits      = 0
+        self.misses    = 0
+
+    def get(self, url, timeout, poolsize=SOLR_POOLSIZE):
+        # eine Session je (URL, Poolgroesse): SOLRPOOLSIZE gilt pro Mandant
+        key = (url, timeout, poolsize)
+        with self._lock:
+            solr = self._clients.get(key)
+            if solr is not None:
+                self.hits = self.hits + 1
+                return solr
+            self.misses = self.misses + 1
+            session = self._sessions.get((url, poolsize))
+            if session is None:
+                session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=poolsize)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._sessions[(url, poolsize)] = session
+            solr = pysolr.Solr(url, timeout=timeout, session=session, decoder=solr_decoder())
+            self._clients[key] = solr
+            Log('New Solr client %s (timeout %s, poolsize %s)', url, timeout, poolsize, level=logging.INFO)
+            return solr
+
+    def stats(self):
+        S = { "hits":self.hits, "misses":self.misses, "urls":{} }
+        with self._lock:
+            for (url, poolsize), session in self._sessions.items():
+                adapter = session.get_adapter(url)
+                connections = 0
+                requests_sent = 0
+                for key in adapter.poolmanager.pools.keys():
+                    pool = adapter.poolmanager.pools[key]
+                    connections = connections + pool.num_connections
+                    requests_sent = requests_sent + pool.num_requests
+                S["urls"]["%s (poolsize %s)" % (url, poolsize)] = { "connections":connections, "requests":requests_sent }
+        return S
+
+
+SOLR_POOL = SolrPool()
+
+
+class OrjsonDecoder:
+    # Dekodierer fuer pysolr (wie json.JSONDecoder nur decode())
+    def decode(self, s):
+        return orjson.loads(s)
+
+
+def solr_decoder():
+    if SOLR_DECODER == 'orjson' and orjson is not None:
+        return OrjsonDecoder()
+    return json.JSONDecoder()
+
+# Threads fuer parallele Solr Teilanfragen
+SOLR_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=SOLR_THREADS)
+
+# Threads, die gestreamte /json Antworten unabhaengig vom Client fertig bauen
+STREAM_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=SOLR_THREADS)
+
+
+class Latency:
+    # gleitender Mittelwert (EWMA) der Antwortzeiten in Sekunden
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self.ewma  = 0.0
+        self.count = 0
+
+    def add(self, seconds):
+        if self.count == 0:
+            self.ewma = seconds
+        else:
+            self.ewma = self.alpha * seconds + (1 - self.alpha) * self.ewma
+        self.count = self.count + 1
+
+
+SOLR_LATENCY = Latency()
+
+# Threads fuer die Anfragen an einzelne Replicas (auch Zweitanfragen)
+HEDGE_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=SOLR_THREADS * 2)
+
+
+class Counter:
+    def __init__(self):
+        self._lock  = threading.Lock()
+        self._value = 0
+
+    def add(self, n):
+        with self._lock:
+            self._value = self._value + n
+
+    def value(self):
+        return self._value
+
+
+HEDGE_INFLIGHT = Counter()   # laufende Anfragen im HEDGE_EXECUTOR
+
+
+class SolrQueryError(pysolr.SolrError):
+    # HTTP 4xx: die Anfrage ist fehlerhaft, nicht die Replica
+    pass
+
+
+class Replica:
+    # Zustand einer Solr URL (fuer alle Mandanten): Latenz und Fehlerquote
+    # der letzten REPLICA_FAILURE_WINDOW Sekunden. Ab REPLICA_FAILURE_RATE
+    # (und REPLICA_MIN_REQUESTS Anfragen) fuer REPLICA_RETRY Sekunden
+    # gesperrt; scheitert der erste Versuch danach, sofort wieder.
+    def __init__(self, url):
+        self.url        = url
+        self._lock      = threading.Lock()   # geteilt von allen Mandanten und HEDGE_EXECUTOR Threads
+        self.latency    = Latency()
+        self.recent     = collections.deque(maxlen=REPLICA_WINDOW)
+        self.outcomes   = collections.deque()   # (Zeit, Fehler) im REPLICA_FAILURE_WINDOW
+        self.retrying   = False
+        self.open_until = 0.0
+        self.requests   = 0
+        self.errors     = 0
+
+    def available(self, now):
+        return self.open_until <= now
+
+    def hedge_delay(self):
+        with self._lock:
+            return self._hedge_delay()
+
+    def _hedge_delay(self):
+        # p95 der letzten Antwortzeiten, bis genug vorliegen HEDGE_DELAY
+        if len(self.recent) < 20:
+            return HEDGE_DELAY
+        recent = sorted(self.recent)
+        return max(HEDGE_MIN_DELAY, recent[int(len(recent) * 0.95) - 1])
+
+    def success(self, seconds):
+        with self._lock:
+            self.requests = self.requests + 1
+            self.retrying = False
+            self._record(seconds, False)
+
+    def failure(self, seconds):
+        # auch die Zeit bis zum Fehler zaehlt, sonst bleibt eine haengende Replica "schnell"
+        with self._lock:
+            self.requests = self.requests + 1
+            self.errors   = self.errors + 1
+            now = self._record(seconds, True)
+            failed = len([f for (t, f) in self.outcomes if f])
+            disable = self.retrying or (len(self.outcomes) >= REPLICA_MIN_REQUESTS
+                                        and failed >= REPLICA_FAILURE_RATE * len(self.outcomes))
+            if disable:
+                self.open_until = now + REPLICA_RETRY
+                self.retrying   = True
+                self.outcomes.clear()
+        if disable:
+            Log('Solr replica %s disabled for %s seconds', self.url, REPLICA_RETRY, level=logging.WARNING)
+
+    def _record(self, seconds, failed):
+        # nur mit self._lock
+        now = time.monotonic()
+        self.recent.append(seconds)
+        self.latency.add(seconds)
+        self.outcomes.append((now, failed))
+        while self.outcomes and self.outcomes[0][0] < now - REPLICA_FAILURE_WINDOW:
+            self.outcomes.popleft()
+        return now
+
+    def stats(self):
+        with self._lock:
+            return { "requests":self.requests, "errors":self.errors,
+                     "latency":self.latency.ewma, "hedgedelay":self._hedge_delay(),
+                     "disabled":not self.available(time.monotonic()) }
+
+
+class SolrBackend:
+    # Solr ueber die Replicas eines Mandanten (GVIURLS), search() wie
+    # pysolr. Erst die schnellste verfuegbare Replica; antwortet sie nicht
+    # innerhalb ihres p95, geht eine Zweitanfrage an die naechste (hedging,
+    # hoechstens HEDGE_MAX_INFLIGHT gleichzeitig). Fehler -> naechste
+    # Replica, HTTP 4xx sofort. Sind alle gesperrt, werden trotzdem alle
+    # versucht.
+    def __init__(self, urls, timeout, poolsize):
+        self.replicas = [get_replica(url) for url in urls]
+        self.timeout  = timeout
+        self.poolsize = poolsize
+
+    def search(self, q, **kwargs):
+        now = time.monotonic()
+        candidates = sorted([r for r in self.replicas if r.available(now)], key=lambda r: r.latency.ewma)
+        if candidates == []:
+            candidates = sorted(self.replicas, key=lambda r: r.latency.ewma)
+        if len(candidates) == 1 or HEDGE_INFLIGHT.value() >= HEDGE_MAX_INFLIGHT:
+            return self._failover(candidates, q, kwargs)
+
+        futures = {}
+        error   = None
+        first   = candidates.pop(0)
+        futures[self._submit(first, q, kwargs)] = first
+        delay   = first.hedge_delay()
+        while futures != {}:
+            (done, pending) = concurrent.futures.wait(list(futures), timeout=delay,
+                                                      return_when=concurrent.futures.FIRST_COMPLETED)
+            delay = None
+            for future in done:
+                del futures[future]
+                try:
+                    return future.result()
+                except SolrQueryError:
+                    raise
+                except Exception as e:
+                    error = e
+            if done == set() and HEDGE_INFLIGHT.value() >= HEDGE_MAX_INFLIGHT:
+                continue
+            if candidates != [] and (done == set() or futures == {}):
+                replica = candidates.pop(0)
+                if done == set():
+                    Log('Hedged Solr request to %s', replica.url, level=logging.INFO)
+                    REPLICA_STATS["hedged"] = REPLICA_STATS["hedged"] + 1
+                else:
+                    Log('Solr request failed over to %s', replica.url, level=logging.INFO)
+                    REPLICA_STATS["failover"] = REPLICA_STATS["failover"] + 1
+                futures[self._submit(replica, q, kwargs)] = replica
+        raise error
+
+    def _failover(self, candidates, q, kwargs):
+        # ohne Zweitanfragen im aufrufenden Thread, eine Replica nach der anderen
+        error = None
+        for replica in candidates:
+            if error is not None:
+                Log('Solr request failed over to %s', replica.url, level=logging.INFO)
+                REPLICA_STATS["failover"] = REPLICA_STATS["failover"] + 1
+            try:
+                return self._search(replica, q, kwargs)
+            except SolrQueryError:
+                raise
+            except Exception as e:
+                error = e
+        raise error
+
+    def _submit(self, replica, q, kwargs):
+        HEDGE_INFLIGHT.add(1)
+        future = HEDGE_EXECUTOR.submit(self._search, replica, q, kwargs)
+        future.add_done_callback(lambda f: HEDGE_INFLIGHT.add(-1))
+        return future
+
+    def _search(self, replica, q, kwargs):
+        solr  = SOLR_POOL.get(replica.url, self.timeout, self.poolsize)
+        start = time.monotonic()
+        try:
+            results = solr.search(q, **kwargs)
+        except pysolr.SolrError as e:
+            status = re.search(r'\(HTTP (4\d\d)\)', str(e))
+            if status is not None:
+                replica.success(time.monotonic() - start)
+                raise SolrQueryError(str(e))
+            replica.failure(time.monotonic() - start)
+            raise
+        replica.success(time.monotonic() - start)
+        return results
+
+
+REPLICAS      = {}
+BACKENDS      = {}
+REPLICA_STATS = { "hedged":0, "failover":0 }
+
+def get_replica(url):
+    replica = REPLICAS.get(url)
+    if replica is None:
+        replica = REPLICAS.setdefault(url, Replica(url))
+    return replica
+
+def get_solr(config, timeout, urls=None):
+    # urls: Replicas eines weiteren Cores (CORES), sonst GVIURLS
+    key = (tuple(urls or config.get_gviurls()), config.get_timeout(timeout), config.get_poolsize())
+    backend = BACKENDS.get(key)
+    if backend is None:
+        backend = BACKENDS.setdefault(key, SolrBackend(*key))
+    return backend
+
+def replica_stats():
+    S = dict(REPLICA_STATS)
+    S["inflight"] = HEDGE_INFLIGHT.value()
+    S["urls"] = dict((url, replica.stats()) for (url, replica) in list(REPLICAS.items()))
+    return S
+
+
+class SubRequests:
+    # unabhaengige Solr Anfragen eines /json Aufrufs, parallel bis zu einer
+    # gemeinsamen Deadline (timeAllowed per limit()). Kritische werfen bei
+    # Fehler/Deadline und brechen noch nicht gestartete ab, die anderen
+    # liefern ihren default und stehen in missed (wie partialResults).
+    def __init__(self, timeout):
+        self.deadline  = time.monotonic() + timeout
+        self.missed    = []
+        self.cancelled = False
+        self._futures  = {}
+
+    def submit(self, name, fn, *args, critical=True, default=None):
+        self._futures[name] = (SOLR_EXECUTOR.submit(self._timed, fn, *args), critical, default)
+
+    def limit(self, params):
+        # Solr hoert vor uns auf zu warten, damit seine partialResults
+        # Antwort noch vor der Deadline ankommt
+        left = self.deadline - time.monotonic()
+        left = left - max(SOLR_DEADLINE_MARGIN, left * 0.1)
+        params['timeAllowed'] = max(1, int(left * 1000))
+        return params
+
+    def check(self, name, results):
+        if results.raw_response.get('responseHeader', {}).get('partialResults'):
+            Log('Sub-request %s: partial results after timeAllowed', name, level=logging.INFO)
+            self.missed.append(name)
+        return results
+
+    def _timed(self, fn, *args):
+        start = time.monotonic()
+        if self.cancelled or start > self.deadline:
+            raise concurrent.futures.TimeoutError('Sub-request not started before the deadline')
+        result = fn(*args)
+        SOLR_LATENCY.add(time.monotonic() - start)
+        return result
+
+    def result(self, name):
+        (future, critical, default) = self._futures[name]
+        try:
+            return future.result(timeout=max(0, self.deadline - time.monotonic()))
+        except Exception as e:
+            if critical:
+                # die Antwort scheitert, der Rest wird nicht mehr gebraucht
+                self.cancel()
+                raise
+            future.cancel()
+            Log('Sub-request %s failed: %r', name, e, level=logging.WARNING)
+            self.missed.append(name)
+            return default
+
+    def cancel(self):
+        self.cancelled = True
+        for (future, critical, default) in self._futures.values():
+            future.cancel()
+
+
+class LRUCache:
+    # threadsicherer LRU Cache mit TTL pro Eintrag (0 = nicht cachen),
+    # begrenzt auf maxentries Eintraege und maxbytes Bytes (bytes mit ihrer
+    # Laenge, sonst das Attribut size); gewachsene Eintraege per resize()
+    def __init__(self, maxentries, maxbytes=None):
+        self._lock       = threading.Lock()
+        self._data       = collections.OrderedDict()   # key -> (expires, size, value)
+        self._bytes      = 0
+        self.maxentries  = maxentries
+        self.maxbytes    = maxbytes
+        self.hits        = 0
+        self.misses      = 0
+        self.evictions   = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses = self.misses + 1
+                return None
+            (expires, size, value) = entry
+            if expires is not None and expires < time.monotonic():
+                self._remove(key)
+                self.expirations = self.expirations + 1
+                self.misses = self.misses + 1
+                return None
+            self._data.move_to_end(key)
+            self.hits = self.hits + 1
+            return value
+
+    def put(self, key, value, ttl=None):
+        if ttl is not None and ttl <= 0:
+            return
+        size = len(value) if isinstance(value, bytes) else getattr(value, 'size', 0)
+        if self.maxbytes is not None and size > self.maxbytes:
+            return
+        expires = None if ttl is None else time.monotonic() + ttl
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (expires, size, value)
+            self._bytes = self._bytes + size
+            self._evict()
+
+    def resize(self, key, value):
+        # value (noch unter key gespeichert) ist gewachsen, z.B. um eine
+        # komprimierte Fassung: neu zaehlen und wenn noetig verdraengen
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[2] is not value:
+                return
+            (expires, size, value) = entry
+            self._data[key] = (expires, value.size, value)
+            self._bytes = self._bytes + value.size - size
+            self._evict()
+
+    def _evict(self):
+        while len(self._data) > self.maxentries or \
+              (self.maxbytes is not None and self._bytes > self.maxbytes):
+            self._remove(next(iter(self._data)))
+            self.evictions = self.evictions + 1
+
+    def contains(self, key):
+        # wie get() != None, aber ohne Statistik und LRU Reihenfolge
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and (entry[0] is None or entry[0] >= time.monotonic())
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        (expires, size, value) = self._data.pop(key)
+        self._bytes = self._bytes - size
+
+    def stats(self):
+        return { "entries":len(self._data), "bytes":self._bytes,
+                 "hits":self.hits, "misses":self.misses,
+                 "evictions":self.evictions, "expirations":self.expirations }
+
+
+class SingleFlight:
+    # gleichzeitige identische Berechnungen im Worker nur einmal: der erste
+    # Aufrufer (Leader) rechnet, die anderen warten auf sein Ergebnis oder
+    # seine Exception. begin/wait/finish einzeln fuer gestreamte Antworten.
+    class Call:
+        def __init__(self):
+            self.done      = threading.Event()
+            self.result    = None
+            self.error     = None
+            self.followers = 0
+
+    def __init__(self):
+        self._lock     = threading.Lock()
+        self._calls    = {}
+        self.leaders   = 0
+        self.followers = 0
+
+    def begin(self, key):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = SingleFlight.Call()
+                self.leaders = self.leaders + 1
+                return (call, True)
+            self.followers = self.followers + 1
+            call.followers = call.followers + 1
+            return (call, False)
+
+    def release(self, key, call):
+        # Leader ohne Ergebnis fuer andere (z.B. nicht cachebar): nur wenn
+        # noch niemand wartet, wird key freigegeben (True); finish() entfaellt
+        with self._lock:
+            if call.followers > 0:
+                return False
+            del self._calls[key]
+            return True
+
+    def wait(self, call):
+        Log('Waiting for identical request in flight')
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def finish(self, key, call, result=None, error=None):
+        call.result = result
+        call.error  = error
+        with self._lock:
+            del self._calls[key]
+        call.done.set()
+
+    def do(self, key, fn, *args):
+        (call, leader) = self.begin(key)
+        if not leader:
+            return self.wait(call)
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            self.finish(key, call, error=e)
+            raise
+        self.finish(key, call, result)
+        return result
+
+    def stats(self):
+        return { "inflight":len(self._calls), "leaders":self.leaders, "followers":self.followers }
+
+
+class Prefetcher:
+    # Hintergrund-Jobs fuer RESPONSE_CACHE: hoechstens threads gleichzeitig
+    # und per_minute pro Minute, sonst verworfen (keine Warteschlange);
+    # ebenso, solange die Solr Latenz ueber max_latency liegt
+    def __init__(self, threads, per_minute, max_latency):
+        self._executor   = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self._slots      = threading.BoundedSemaphore(threads)
+        self._lock       = threading.Lock()
+        self._window     = time.monotonic()
+        self._started    = 0
+        self.per_minute  = per_minute
+        self.max_latency = max_latency
+        self.started     = 0
+        self.dropped     = 0
+        self.cancelled   = 0
+
+    def schedule(self, fn, *args):
+        # erst der Platz, dann das Budget: ohne freien Platz verworfene
+        # Prefetches verbrauchen kein Budget
+        if SOLR_LATENCY.ewma > self.max_latency or not self._slots.acquire(blocking=False):
+            self._count('dropped')
+            return
+        if not self._take_budget():
+            self._slots.release()
+            self._count('dropped')
+            return
+        self._count('started')
+        self._executor.submit(self._run, fn, *args)
+
+    def _count(self, name):
+        # started/dropped/cancelled aus Request- und Prefetch-Threads
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def _take_budget(self):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._window > 60:
+                self._window  = now
+                self._started = 0
+            if self._started >= self.per_minute:
+                return False
+            self._started = self._started + 1
+            return True
+
+    def _run(self, fn, *args):
+        try:
+            if SOLR_LATENCY.ewma > self.max_latency:
+                self._count('cancelled')
+                return
+            fn(*args)
+        except Exception as e:
+            Log('Prefetch failed: %r', e, level=logging.WARNING)
+        finally:
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return { "started":self.started, "dropped":self.dropped, "cancelled":self.cancelled }
+
+
+PREFETCHER = Prefetcher(PREFETCH_THREADS, PREFETCH_PER_MINUTE, PREFETCH_MAX_LATENCY)
+
+
+# Fertige JSON Antworten von /json, Schluessel siehe do_json
+RESPONSE_CACHE = LRUCache(RESPONSE_CACHE_ENTRIES, RESPONSE_CACHE_BYTES)
+SINGLEFLIGHT   = SingleFlight()
+# Facetten pro (Mandant, Anfrage, Filter), unabhaengig vom Paging
+FACET_CACHE    = LRUCache(FACET_CACHE_ENTRIES)
+# Trefferzahlen fuer COUNTMODE 'cached', gleicher Schluessel wie FACET_CACHE
+TOTAL_CACHE    = LRUCache(FACET_CACHE_ENTRIES)
+# Konvertierte PNX Dokumente, Schluessel (GVI id, Mandant, Hash der Bestaende)
+PNX_CACHE      = LRUCache(PNX_CACHE_ENTRIES)
+
+
+def get_stats():
+    return { "solr":SOLR_POOL.stats(), "responses":RESPONSE_CACHE.stats(),
+             "pnx":PNX_CACHE.stats(),
+             "facets":FACET_CACHE.stats(),
+             "totals":TOTAL_CACHE.stats(),
+             "singleflight":SINGLEFLIGHT.stats(),
+             "prefetch":PREFETCHER.stats(),
+             "replicas":replica_stats(),
+             "latency":SOLR_LATENCY.ewma }
+
+
 
 FACETQUERYREPLACE = [
     ('facet_creator','author'),
@@ -198,6 +992,7 @@ FACET_MAP = { 'creator': 'author_facet',
               'library': 'consortium' }
 
 FACET_PREFIX = 'facet_'
+ID_TERM_PATTERN = re.compile(r'^\(*((?:id:)*)(\(?)"([^"]+)"(\)*)$')
 FACET_QUERY_PATTERN = ' *(AND NOT|AND) *facet_'
                  
 CATALOGUE_MAP = {
@@ -213,6 +1008,24 @@ CATALOGUE_MAP = {
     'AT-OBV': 'OBV Verbundkatalog'
     }
 
+# Filter fuer /json und /json/export, FILTERS im Mandanten ergaenzt sie
+JSON_FILTERS = ["-consortium:DE-627", 
+              # "-consortium:\"DE-600\"", 
+              # "-consortium:\"DE-101\"", 
+              # "-consortium:\"DE-603\"",      # Hebis raus
+              "-institution_id:UNDEFINED", # Überordnungen
+              "-institution_id:DE-603",    # HEBIS Katalogkarten 
+              "-id:\\(DE-602\\)edochu_*",
+              "-id:\\(DE-602\\)kobvindex_JMB*",
+              "-consortium:\"AT-OBV\"", 
+              "-consortium:\"FL\"",     
+              "-collection:\"HBZFIX\"",
+              "-consortium:\"UNDEFINED\"", 
+              #'{!collapse field=test_matchkey_3}', # collapse raus
+              # "-allfields_unstemmed:Safari"]
+              #"-allfields:Safari"
+              ]
+
 SORT_MAP = {
     'screator': 'author_sort asc',
     'stitle':   'title_sort asc',
@@ -225,9 +1038,26 @@ SOLR_QF      = 'title_unstemmed^400 author_norm^300 author_unstemmed^50 subject_
 SOLR_DEFTYPE = 'edismax'
 SOLR_MM      = '0%'
                
-def Log(s):
-    # print (s, file=sys.stderr)
-    logging.info(s)
+LOGGER      = logging.getLogger('gvi2pnx')
+REQUEST_LOG = threading.local()        # debug: DEBUG = True im Mandanten der laufenden Anfrage
+
+def Log(msg, *args, level=logging.DEBUG):
+    # msg % args wird erst formatiert, wenn die Meldung ausgegeben wird.
+    # DEBUG Meldungen erscheinen beim Log Level DEBUG oder (als INFO) in
+    # Anfragen eines Mandanten mit DEBUG = True.
+    if level == logging.DEBUG and getattr(REQUEST_LOG, 'debug', False):
+        level = logging.INFO
+    LOGGER.log(level, msg, *args, stacklevel=2)
+
+def debug_enabled():
+    # fuer Meldungen, deren Argumente selbst teuer sind
+    return getattr(REQUEST_LOG, 'debug', False) or LOGGER.isEnabledFor(logging.DEBUG)
+
+def log_request(config=None):
+    # am Anfang jeder Anfrage (und jedes Hintergrund-Jobs): REQUEST_LOG ist
+    # pro Thread und hielte sonst den Wert der vorigen Anfrage.
+    # Ohne config (Mandant noch unbekannt) kein Debug.
+    REQUEST_LOG.debug = config is not None and config._debug
 
 def rewrite_parameters(p_query, p_facet_query, p_sort, p_from, p_bulksize):
     try:
@@ -246,16 +1076,18 @@ def rewrite_parameters(p_query, p_facet_query, p_sort, p_from, p_bulksize):
     if p_query is None:   
         p_query = "Bauhaus Möbel"
     
-    if (p_query[:4]=='(("(' or p_query[:4]=='(rid:("(') and p_query[-2:]=='))':
+    if p_query[:4]=='(("(' and p_query[-2:]=='))':
         p_query = 'id:%s' % p_query[2:-2]
+    elif p_query[:8]=='(rid:("(' and p_query[-2:]=='))':
+        p_query = 'id:%s' % p_query[5:-1]
         
     q_list = re.split(FACET_QUERY_PATTERN, p_query)
     p_query = q_list[0]
-    Log('Split: %s %s' % (len(q_list),q_list))
+    Log('Split: %s %s', len(q_list),q_list)
     
     i = 2
     while i<len(q_list):
-        Log('FQ:  %s  %s' % (q_list[i-1], q_list[i]))
+        Log('FQ:  %s  %s', q_list[i-1], q_list[i])
         operator = q_list[i-1]
         [category,term] = q_list[i].split(':',2)
         if term[0] == '(':
@@ -273,10 +1105,10 @@ def rewrite_parameters(p_query, p_facet_query, p_sort, p_from, p_bulksize):
                     pass
             if operator == 'AND':
                 p_facet_query.append('%s:%s' % (category,term))
-                Log('%s:"%s"' % (category,term))
+                Log('%s:"%s"', category,term)
             elif operator == 'AND NOT':
                 p_facet_query.append('-%s:%s' % (category,term))
-                Log('-%s:"%s"' % (category,term))
+                Log('-%s:"%s"', category,term)
         except:
             pass
         i=i+2
@@ -310,6 +1142,174 @@ def remove_nonsort_characters(s, list=['\u009c','\u009C','\u0098']):
     return t
     
 
+class PnxFields:
+    """Werte, die marc_to_pnx beim Durchlauf ueber die Datenfelder sammelt"""
+
+    def __init__(self, pnx_type, pnx_creationdate):
+        self.pnx_type         = pnx_type
+        self.pnx_creationdate = pnx_creationdate
+        self.ill_hash = {}
+        self.acq_hash = {}
+    
+        self.pnx_subject_list     = []
+        self.pnx_contributor_list = []
+        self.pnx_ispartof_list    = []
+        self.pnx_title_list       = []
+        self.pnx_language_list    = []
+        self.pnx_uri_list         = []
+    
+        self.pnx_uri_dict         = {}
+        self.pnx_subject_dict     = {}
+    
+        self.pnx_creator   = None
+        self.pnx_publisher = None
+        self.pnx_thumbnail = None
+    
+        self.pnx_pages     = None
+
+        self.first = {}    # jeweils erstes Feld 250, 362, 501, 502, 505, 520
+
+
+def pnx_field_041(field, p):
+    if 'a' in field:
+        p.pnx_language_list.append(field['a'])
+
+def pnx_field_100(field, p):
+    if 'a' in field:
+        p.pnx_creator = clean_from_id(field['a'])
+
+def pnx_field_245(field, p):
+    if 'a' in field:
+        p.pnx_title_list.append(remove_nonsort_characters(field['a']))
+        if 'b' in field:
+            p.pnx_title_list.append(remove_nonsort_characters(field['b']))
+
+def pnx_field_publication(field, p):
+    # 260 nur solange noch kein Verlag bekannt ist, 264 immer
+    if field.tag=="260" and p.pnx_publisher is not None:
+        return
+    if 'a' in field:
+        p.pnx_publisher = field['a']
+        p.ill_hash["EOrt"] = field['a']
+        p.acq_hash["place"] = field['a']
+    if 'b' in field:
+        p.ill_hash["Verlag"] = field['b']
+        if p.pnx_publisher is None:
+            p.pnx_publisher = field['b']
+        else:
+            p.pnx_publisher = "%s : %s" % (p.pnx_publisher,field['b'])
+    if 'c' in field:
+        if p.pnx_creationdate is None:
+            p.pnx_creationdate = field['c']
+
+def pnx_field_300(field, p):
+    if 'a' in field:
+        p.pnx_pages = field['a']
+
+def pnx_field_subject(field, p):
+    if 'a' in field:
+        keyword = field['a']
+        if not keyword in p.pnx_subject_dict:
+            p.pnx_subject_list.append(keyword)
+            p.pnx_subject_dict[keyword] = 1
+
+def pnx_field_700(field, p):
+    if 'a' in field:
+        contributor = field['a']
+        if 'e' in field:
+            contributor = "%s (%s)" % (contributor, field['e'])
+        p.pnx_contributor_list.append(contributor)
+
+def pnx_field_773(field, p):
+    if p.pnx_type == "article" or 'i' in field:
+        if p.pnx_type == "article" or 'in' in field['i'].lower():
+            while 'i' in field:
+                field.delete_subfield('i')
+            while 'w' in field:
+                field.delete_subfield('w')
+            while 't' in field:
+                p.pnx_ispartof_list.append(field['t']) 
+                field.delete_subfield('t')
+            while 'g' in field:
+                tmpstr = field['g']
+                if tmpstr[:6] == 'pages:':
+                    p.ill_hash["Seiten"] = tmpstr[6:]
+                else:
+                    p.pnx_ispartof_list.append(field['g']) 
+                field.delete_subfield('g')
+
+def pnx_field_856(field, p):
+    if 'q' in field  and 'u' in field and '3' in field:
+        if field['q']=="image/gif" and field['3'].find("Katalogkarte")>=0:
+            p.pnx_thumbnail="$$U%s" % field['u']       
+    if 'z' in field and 'u' in field:
+        if field['z'].lower()=="kostenfrei":
+            if 'x' not in field:
+                entry = "$$U%s$$DVolltext" % (field['u'])
+            else:
+                entry = "$$U%s$$D%s (Volltext)" % (field['u'], field['x'])
+            if not entry in p.pnx_uri_dict:
+                p.pnx_uri_list.append(entry)
+                p.pnx_uri_dict[entry] = 1
+
+def pnx_field_first(field, p):
+    if field.tag not in p.first:
+        p.first[field.tag] = field
+
+
+PNX_FIELD_HANDLERS = {
+    '041': pnx_field_041,
+    '100': pnx_field_100,
+    '245': pnx_field_245,
+    '250': pnx_field_first,
+    '260': pnx_field_publication,
+    '264': pnx_field_publication,
+    '300': pnx_field_300,
+    '362': pnx_field_first,
+    '501': pnx_field_first,
+    '502': pnx_field_first,
+    '505': pnx_field_first,
+    '520': pnx_field_first,
+    '650': pnx_field_subject,
+    '655': pnx_field_subject,
+    '689': pnx_field_subject,
+    '700': pnx_field_700,
+    '773': pnx_field_773,
+    '856': pnx_field_856,
+    }
+
+# Datenfelder, die marc_to_pnx auswertet: die Tabelle oben plus ISBN/ISSN
+# (record.isbn, record.issn); .pubyear und .physicaldescription lesen
+# 260/264 und 300
+PNX_TAGS = frozenset(PNX_FIELD_HANDLERS) | frozenset(['020', '022'])
+
+def parse_marcxml(marcxml, tags=None):
+    # ein MARCXML Record (<record> oder <collection> mit einem) wie
+    # parse_xml_to_array, aber mit dem C ElementTree Parser; mit tags nur
+    # diese Datenfelder. None ohne Record.
+    root = ET.fromstring(marcxml)
+    if root.tag.rpartition('}')[2] != 'record':
+        root = next((e for e in root if e.tag.rpartition('}')[2] == 'record'), None)
+        if root is None:
+            return None
+    record = Record()
+    for element in root:
+        name = element.tag.rpartition('}')[2]
+        if name == 'datafield':
+            tag = element.get('tag')
+            if tags is not None and tag not in tags:
+                continue
+            subfields = [Subfield(s.get('code'), s.text or '') for s in element]
+            record.fields.append(Field(tag,
+                                       Indicators(element.get('ind1', ' '), element.get('ind2', ' ')),
+                                       subfields))
+        elif name == 'controlfield':
+            record.fields.append(Field(element.get('tag'), data=element.text or ''))
+        elif name == 'leader':
+            record.leader = Leader(element.text or '')
+    return record
+
+
 def marc_to_pnx(gvi_id, pnx_sourcerecordid, pnx_sourcesystem, pnx_recordid, 
                 pnx_type, pnx_language, pnx_institutions, delcategory,
                 link_templates, openurl_templates, baseurl_templates, isils, record, debug_flag):
@@ -351,13 +1351,13 @@ def marc_to_pnx(gvi_id, pnx_sourcerecordid, pnx_sourcesystem, pnx_recordid,
     except:
         pnx_source='GVI'
        
-    Log("Record: %s\n" % record.as_json())
- 
-    for entry in record.physicaldescription:
-        Log("pnx_format: %s" % entry)
-    Log("pnx_creationdate: %s" % record.pubyear)
-    Log("pnx_isbn: %s" % record.isbn)
-    Log("pnx_issn: %s" % record.issn) 
+    if debug_enabled():
+        Log("Record: %s\n", record.as_json())
+        for entry in record.physicaldescription:
+            Log("pnx_format: %s", entry)
+        Log("pnx_creationdate: %s", record.pubyear)
+        Log("pnx_isbn: %s", record.isbn)
+        Log("pnx_issn: %s", record.issn)
  
     pnx_format       = '' # record.physicaldescription()
     pnx_creationdate = record.pubyear
@@ -366,140 +1366,26 @@ def marc_to_pnx(gvi_id, pnx_sourcerecordid, pnx_sourcesystem, pnx_recordid,
 	
 
     openurl_hash = {}
-    ill_hash = {}
-    acq_hash = {}
-    
-    pnx_subject_list     = []
-    pnx_contributor_list = []
-    pnx_ispartof_list    = []
-    pnx_title_list       = []
-    pnx_language_list    = []
-    pnx_uri_list         = []
-    
-    pnx_uri_dict         = {}
-    pnx_subject_dict     = {}
-    
-    pnx_creator   = None
-    pnx_publisher = None
-    pnx_thumbnail = None
-    
-    pnx_pages     = None
-
-    for field in record.get_fields():
-        Log('Field: %s' % field)
-        if field.tag=='041' and 'a' in field:
-                Log('working on 041 %s' % field['a'])
-            #while field['a' in field:
-                pnx_language_list.append(field['a']) 
-                #field.delete_subfield('a')
-                
-        if field.tag=='100' and 'a' in field:
-            pnx_creator  = clean_from_id(field['a'])
-		
-        if field.tag=='245' and 'a' in field:
-            pnx_title_list.append(remove_nonsort_characters(field['a']))
-            Log('pnx_title_list: %s' % pnx_title_list)
-            if 'b' in field:
-                pnx_title_list.append(remove_nonsort_characters(field['b']))
-            
-        if field.tag=='245' and 'a' in field:      
-            title = field['a']
-            if 'b' in field:
-                title = "%s: %s" % (title, field['b'])
-            pnx_title = remove_nonsort_characters(title)
-		
-        #if field.tag=='246' and field['a' in field:
-        #    pnx_title_list.append(remove_nonsort_characters(field['a']))   
-
-        if field.tag=="260" and pnx_publisher is None:
-            if 'a' in field:
-                pnx_publisher = field['a']
-                ill_hash["EOrt"] = field['a']
-                acq_hash["place"] = field['a']
-            if 'b' in field:
-                ill_hash["Verlag"] = field['b']
-                if pnx_publisher is None:
-                    pnx_publisher = field['b']
-                else:
-                    pnx_publisher = "%s : %s" % (pnx_publisher,field['b'])
-            if 'c' in field:
-                if pnx_creationdate is None:
-                    pnx_creationdate = field['c'] 
-
-        if field.tag=="264": # and pnx_publisher is None:
-            if 'a' in field:
-                pnx_publisher = field['a'] 
-                ill_hash["EOrt"] = field['a']
-                acq_hash["place"] = field['a']
-            if 'b' in field:
-                ill_hash["Verlag"] = field['b']
-                if pnx_publisher is None:
-                    pnx_publisher = field['b']
-                else:
-                    pnx_publisher = "%s : %s" % (pnx_publisher,field['b'])
-            if 'c' in field:
-                if pnx_creationdate is None:
-                    pnx_creationdate = field['c'] 
-                    
-        if field.tag=="300": 
-            if 'a' in field:
-                pnx_pages = field['a']
-        
-        
-        if field.tag in ['650', '655', '689'] and 'a' in field:
-            keyword = field['a']
-            if not keyword in pnx_subject_dict:
-                pnx_subject_list.append(keyword)
-                pnx_subject_dict[keyword] = 1
-		
-        if field.tag=='700' and 'a' in field:
-            contributor = field['a']
-            if 'e' in field:
-                contributor = "%s (%s)" % (contributor, field['e'])
-            pnx_contributor_list.append(contributor)
-             
-#        if field.tag=='773' and field['i'] is not None:
-#            # Log('working on 773')
-#            # if field['i'] == 'In':
-#            if field['i'] is not None:
-#                if 'in' in field['i'].lower():
-#                    field.delete_subfield('i')
-#                    while field['w'] is not None:
-#                        field.delete_subfield('w')
-#                    pnx_ispartof_list.append(field.format_field())   
-#                    # pnx_ispartof_list.append(field.format_field()[3:])   
-        
-        if field.tag=='773' and (pnx_type == "article" or 'i' in field):
-            if pnx_type == "article" or 'in' in field['i'].lower():
-                while 'i' in field:
-                    field.delete_subfield('i')
-                while 'w' in field:
-                    field.delete_subfield('w')
-                while 't' in field:
-                    pnx_ispartof_list.append(field['t']) 
-                    field.delete_subfield('t')
-                while 'g' in field:
-                    tmpstr = field['g']
-                    if tmpstr[:6] == 'pages:':
-                        ill_hash["Seiten"] = tmpstr[6:]
-                    else:
-                        pnx_ispartof_list.append(field['g']) 
-                    field.delete_subfield('g')
 
-            
-        if field.tag=='856' and 'q' in field  and 'u' in field and '3' in field:
-            if field['q']=="image/gif" and field['3'].find("Katalogkarte")>=0:
-                pnx_thumbnail="$$U%s" % field['u']       
-        
-        if field.tag=='856' and 'z' in field and 'u' in field:
-            if field['z'].lower()=="kostenfrei":
-                if 'x' not in field:
-                    entry = "$$U%s$$DVolltext" % (field['u'])
-                else:
-                    entry = "$$U%s$$D%s (Volltext)" % (field['u'], field['x'])
-                if not entry in pnx_uri_dict:
-                    pnx_uri_list.append(entry)
-                    pnx_uri_dict[entry] = 1
+    p = PnxFields(pnx_type, pnx_creationdate)
+    for field in record.fields:
+        handler = PNX_FIELD_HANDLERS.get(field.tag)
+        if handler is not None:
+            handler(field, p)
+
+    ill_hash             = p.ill_hash
+    acq_hash             = p.acq_hash
+    pnx_subject_list     = p.pnx_subject_list
+    pnx_contributor_list = p.pnx_contributor_list
+    pnx_ispartof_list    = p.pnx_ispartof_list
+    pnx_title_list       = p.pnx_title_list
+    pnx_language_list    = p.pnx_language_list
+    pnx_uri_list         = p.pnx_uri_list
+    pnx_creator          = p.pnx_creator
+    pnx_publisher        = p.pnx_publisher
+    pnx_thumbnail        = p.pnx_thumbnail
+    pnx_pages            = p.pnx_pages
+    pnx_creationdate     = p.pnx_creationdate
         
     pnx_identifier = None
     if pnx_isbn is not None:
@@ -515,22 +1401,16 @@ def marc_to_pnx(gvi_id, pnx_sourcerecordid, pnx_sourcesystem, pnx_recordid,
         
     pnx_description_list = []
     for id in ["501", "502", "505", "520"]:
-        try:
-            pnx_description_list.append(record[id].format_field())
-        except:
-            pass
+        if id in p.first:
+            pnx_description_list.append(p.first[id].format_field())
             
     pnx_coverage = None
-    try:
-        pnx_coverage = record["362"].format_field()
-    except:
-        pass
+    if "362" in p.first:
+        pnx_coverage = p.first["362"].format_field()
     	
     pnx_edition = None
-    try:
-        pnx_edition = record["250"].format_field()
-    except:
-        pass   
+    if "250" in p.first:
+        pnx_edition = p.first["250"].format_field()
     
 # https://www2.bib.uni-mannheim.de/cgi-bin/fernleihe/index.pl?Isbn=3860225499&Titel=QUID&EJahr=1999    
 
@@ -641,11 +1521,11 @@ def marc_to_pnx(gvi_id, pnx_sourcerecordid, pnx_sourcesystem, pnx_recordid,
     #pnx_doc["pnx"]["links"]["linktouc"].append(pnx_openurl)
     
     for (openurl_base, text) in baseurl_templates:
-        Log ("openurl: %s , %s" % ( openurl_base, text))
+        Log("openurl: %s , %s", openurl_base, text)
         pnx_openurl = "$$U%s?%s$$D%s (OpenURL)" % (openurl_base, urlencode(openurl_hash), text)
         pnx_doc["pnx"]["links"]["linktouc"].append(pnx_openurl)
 
-    Log ("linktouc: %s\n" % pnx_doc["pnx"]["links"]["linktouc"] )
+    Log("linktouc: %s\n", pnx_doc["pnx"]["links"]["linktouc"])
     
     for item in pnx_uri_list:
         pnx_doc["pnx"]["links"]["linktouc"].append(item)
@@ -668,7 +1548,7 @@ def marc_to_pnx(gvi_id, pnx_sourcerecordid, pnx_sourcesystem, pnx_recordid,
     # CONSORTIUM_URL_PREFIX = "https://swb.bsz-bw.de/DB=2.1/PPNSET?PRS=HOL&HILN=888&INDEXSET=21&PPN="
     CONSORTIUM_URL_PREFIX = "https://swb.bsz-bw.de/DB=2.1/PPNSET?PRS=HOL&INDEXSET=21&PPN="
 
-    Log('PNX Institutions: %s' % pnx_institutions)
+    Log('PNX Institutions: %s', pnx_institutions)
     if debug_flag:
         pnx_doc["pnx"]["links"]["linktouc"].append("$$U%s$$DBestandsnachweise: %s  *kein Link* (nur als Debug Hilfe)" % ("", pnx_institutions))
 
@@ -739,8 +1619,11 @@ def do_plain():
     _sort     = request.args.get('sort')
     _token    = request.args.get('token')
 
-    Log('\n\n\nNew Request: %s \n-----------' % datetime.datetime.now() )
-    Log("Query: %s\nFrom: %s\nBulksize: %s\nSort: %s\nToken: %s\n" % (_query, _from, _bulksize, _sort, _token))
+    config = get_config(_token)
+    log_request(config)
+
+    Log('\n\n\nNew Request: %s \n-----------', datetime.datetime.now(), level=logging.INFO)
+    Log("Query: %s\nFrom: %s\nBulksize: %s\nSort: %s\nToken: %s\n", _query, _from, _bulksize, _sort, _token)
 
     FQ = []
     T = []
@@ -748,9 +1631,10 @@ def do_plain():
 
     _query, _facetquery, _sort, _from, _bulksize = rewrite_parameters(_query, FQ, _sort, _from, _bulksize)
     # _query, _facetquery, _from, _bulksize = rewrite_parameters(_query, [], _from, _bulksize)
-    Log("After transform:\nQuery: %s\nFrom: %s\nBulksize: %s\nSort: %s\nToken: %s\n" % (_query, _from, _bulksize, _sort, _token))
+    Log("After transform:\nQuery: %s\nFrom: %s\nBulksize: %s\nSort: %s\nToken: %s\n", _query, _from, _bulksize, _sort, _token)
     
-    solr = pysolr.Solr(GVIURL, timeout=10)
+    solr = get_solr(config, SOLR_TIMEOUT_PLAIN)
+    deadline = min(config.get_deadline(), config.get_timeout(SOLR_TIMEOUT_PLAIN))
     results = solr.search(_query, rows=_bulksize, start=_from,
                **{ 'group': 'true',                     # grouping ein
                    'group.field': 'test_matchkey_3',    #
@@ -760,7 +1644,8 @@ def do_plain():
                    'stats': 'true',
                    'stats.field': '{!cardinality=true}test_matchkey_3',
                    'sort' : _sort,
-                   'fl' : '*,score',
+                   'timeAllowed' : int(deadline * 1000),
+                   'fl' : config.get_fl(PLAIN_FIELDS),
                    'mm' : SOLR_MM,
                    'qf' : SOLR_QF,
                    'defType' : SOLR_DEFTYPE,
@@ -794,10 +1679,7 @@ def do_plain():
         T.append("")
         T.append("Group: %s %s %s" % (matchkey, numFound, " ".join(gvi_id_list)) ) 
         T.append("%s  (%s)" % (result["id"], result["material_content_type"][0].lower()))
-        marcxml  = result["fullrecord"]
-        marcfile = io.StringIO(marcxml)
-        reclist  = parse_xml_to_array(marcfile)
-        record   = reclist[0]
+        record   = parse_marcxml(result["fullrecord"])
         #T.append("%s" % record)
         T.append("%s %s" % ('LDR', record.leader))
         for field in record.get_fields():
@@ -809,7 +1691,8 @@ def do_plain():
             #if field.tag=='856' and field['q']=="image/gif" and field['u']!=None and \
             #   field['3']!=None and field['3'].find("Katalogkarte")!=-1:
             #    T.append("%s %s" % ("***",  field['u']))
-    resp = make_response("\n".join(T))
+    (body, encoding) = encode_body("\n".join(T).encode('utf-8'), accepted_encodings())
+    resp = set_encoding(make_response(body), encoding)
     resp.headers.set('Content-type', 'text/plain')
     return resp
 
@@ -827,7 +1710,8 @@ def do_plain():
 
 def do_json():
     # try:
-        Log('\n\n\nNew Request: %s \n-----------' % datetime.datetime.now() )
+        log_request()
+        Log('\n\n\nNew Request: %s \n-----------', datetime.datetime.now(), level=logging.INFO)
          # (title:(sea) OR subject:("water")) AND facet_lang:("fre") AND facet_pfilter:("books") AND facet_creationdate:[2014 TO 2019]
         if FLAG:
             _query    = '((flucht))'
@@ -835,72 +1719,626 @@ def do_json():
             _bulksize = '10'
             _sort     = 'rank'
             _token    = '19-airsb-test'
+            _deadline = None
+            _pretty   = True
         else:
             _query    = request.args.get('query')
             _from     = request.args.get('from')
             _bulksize = request.args.get('bulksize')
             _sort     = request.args.get('sort')
             _token    = request.args.get('token')
+            _deadline = get_number(request.args, 'deadline', float)
+            _pretty   = request.args.get('pretty') == 'true'
             
-        Log("InQuery: %s\nFrom: %s\nBulksize: %s\nSort: %s\nToken: %s\n" % (_query, _from, _bulksize, _sort, _token))
-
-
-        config = Config(_token)
-        link_templates = config.get_links()
-        openurl_templates = config.get_openurls()
-        baseurl_templates = config.get_baseurls()
-        isils = config.get_isils()
-        delcategory = config.get_delcategory()
-        gviurl = config.get_gviurl()
-        if gviurl != None:
-            GVIURL = gviurl
+        Log("InQuery: %s\nFrom: %s\nBulksize: %s\nSort: %s\nToken: %s\n", _query, _from, _bulksize, _sort, _token,
+            level=logging.INFO)
+
+
+        config = get_config(_token)
+        log_request(config)
         
         if not config.validate(_token):
             resp=make_response("{ }")
             resp.headers.set('Content-type', 'application/json')
             return resp
         
-        FQ = ["-consortium:DE-627", 
-              # "-consortium:\"DE-600\"", 
-              # "-consortium:\"DE-101\"", 
-              # "-consortium:\"DE-603\"",      # Hebis raus
-              "-institution_id:UNDEFINED", # Überordnungen
-              "-institution_id:DE-603",    # HEBIS Katalogkarten 
-              "-id:\\(DE-602\\)edochu_*",
-              "-id:\\(DE-602\\)kobvindex_JMB*",
-              "-consortium:\"AT-OBV\"", 
-              "-consortium:\"FL\"",     
-              "-collection:\"HBZFIX\"",
-              "-consortium:\"UNDEFINED\"", 
-              #'{!collapse field=test_matchkey_3}', # collapse raus
-              # "-allfields_unstemmed:Safari"]
-              #"-allfields:Safari"
-              ] + config.get_filters()
+        FQ = JSON_FILTERS + config.get_filters()
               
         _query, _facetquery, _sort, _from, _bulksize = rewrite_parameters(_query, FQ, _sort, _from, _bulksize)
         query = '''(_query_:"{+boost='recip(sub(2022,publish_date_sort),1,1000,1)'+boost='if(exists(query({!v=consortium:DE-576})),1,0.75)'}%s")''' % _query
         # _query = '''(%s +publish_date_sort -consortium:DE-603)^100''' % _query
         
-        Log("After transform:\nTrQuery: %s\nF_Query;%s\nFrom: %s\nBulksize: %s\nSort: %s\nToken: %s\n" % (_query, _facetquery,_from, _bulksize, _sort, _token))
-        
-        solr = pysolr.Solr(GVIURL, timeout=30)
+        Log("After transform:\nTrQuery: %s\nF_Query;%s\nFrom: %s\nBulksize: %s\nSort: %s\nToken: %s\n", _query, _facetquery,_from, _bulksize, _sort, _token)
+
+        # Antwort-Cache: gleiche (umgeschriebene) Anfrage desselben Mandanten.
+        # Gleichzeitige identische Anfragen warten auf die erste (SINGLEFLIGHT).
+        # Eingerueckte Ausgabe nur fuer DEBUG Mandanten oder mit pretty=true
+        pretty = _pretty or config._debug
+        encodings = accepted_encodings()
+        key  = (config._section, _query, tuple(_facetquery), _sort, _from, _bulksize, pretty)
+        # gewartet wird nur auf Anfragen mit derselben Deadline, eine
+        # kuerzere soll nicht auf eine laengere warten
+        flight = key + (_deadline,)
+        # Kompakte Antworten werden gestreamt (entry.body ist dann ein Generator)
+        entry = RESPONSE_CACHE.get(key)
+        try:
+            if entry is None and pretty:
+                entry = SINGLEFLIGHT.do(flight, json_response, config, key, _query, _facetquery, _sort, _from, _bulksize,
+                                        config.get_deadline(_deadline), pretty, encodings)
+            elif entry is None:
+                # gestreamt wird mit gzip (zlib) komprimiert oder gar nicht
+                entry = stream_json(config, key, flight, _query, _facetquery, _sort, _from, _bulksize,
+                                    config.get_deadline(_deadline), 'gzip' if 'gzip' in encodings else None)
+            else:
+                Log('Response cache hit')
+        except concurrent.futures.TimeoutError:
+            return deadline_response(config.get_deadline(_deadline))
+
+        # naechste Seite im Hintergrund in den Antwort-Cache holen
+        if config.get_prefetch() and _from + _bulksize < entry.total:
+            nextkey = key[:4] + (_from + _bulksize, _bulksize, pretty)
+            # schon im Cache: kein Budget verbrauchen
+            if not RESPONSE_CACHE.contains(nextkey):
+                PREFETCHER.schedule(prefetch_json, config, nextkey, _query, _facetquery, _sort, _from + _bulksize, _bulksize, pretty)
+
+        if FLAG:
+            Log("\nPNX/json:\n%s", entry.body.decode('utf-8'))
+        else:
+            variants = len(entry.encoded)
+            (body, encoding) = entry.encode(encodings)
+            if len(entry.encoded) != variants:
+                # neue komprimierte Fassung zaehlt im Antwort-Cache mit
+                RESPONSE_CACHE.resize(key, entry)
+            resp = set_encoding(make_response(body), encoding)
+    #except:
+            #resp=make_response("{ }")
+            resp.headers.set('Content-type', 'application/json')
+            return resp
+
+
+def deadline_response(deadline):
+    # kritische Solr Anfrage nicht bis zur Deadline fertig: JSON statt 500 HTML
+    Log('Deadline of %s seconds exceeded', deadline, level=logging.WARNING)
+    resp = make_response(dump_json({ "error":"deadline exceeded", "deadline":deadline }), 504)
+    resp.headers.set('Content-type', 'application/json')
+    return resp
+
+
+class CachedResponse:
+    # Eintrag im Antwort-Cache: fertiger JSON Body, Trefferzahl und die
+    # schon komprimierten Bodies (encoded). stream_json liefert dem Leader
+    # statt des Bodys einen Generator, komprimiert mit `encoding`.
+    __slots__ = ('body', 'total', 'encoded', 'encoding')
+
+    def __init__(self, body, total, encoding=None):
+        self.body     = body
+        self.total    = total
+        self.encoded  = {}
+        self.encoding = encoding
+
+    def encode(self, encodings):
+        if not isinstance(self.body, bytes):
+            return (self.body, self.encoding)
+        return encode_body(self.body, encodings, self.encoded)
+
+    @property
+    def size(self):
+        return len(self.body) + sum(len(data) for data in self.encoded.values())
+
+
+def accepted_encodings():
+    # Kodierungen aus Accept-Encoding, die wir liefern koennen, in unserer
+    # Reihenfolge (br vor gzip)
+    accepted = {}
+    for part in request.headers.get('Accept-Encoding', '').split(','):
+        fields = part.strip().split(';')
+        q = 1.0
+        for field in fields[1:]:
+            field = field.strip()
+            if field.startswith('q='):
+                try:
+                    q = float(field[2:])
+                except ValueError:
+                    q = 0.0
+        accepted[fields[0].strip().lower()] = q
+    encodings = ['br', 'gzip'] if brotli is not None else ['gzip']
+    return [e for e in encodings if accepted.get(e, accepted.get('*', 0)) > 0]
+
+
+def encode_body(body, encodings, encoded=None):
+    # (Body, Content-Encoding) fuer die erste Kodierung aus encodings;
+    # encoded: schon komprimierte Bodies, wird ergaenzt
+    if encodings == [] or len(body) < COMPRESS_MIN_SIZE:
+        return (body, None)
+    encoding = encodings[0]
+    data = None
+    if encoded is not None:
+        data = encoded.get(encoding)
+    if data is None:
+        if encoding == 'br':
+            data = brotli.compress(body, quality=BROTLI_QUALITY)
+        else:
+            data = gzip.compress(body, compresslevel=GZIP_LEVEL)
+        if encoded is not None:
+            encoded[encoding] = data
+    return (data, encoding)
+
+
+def set_encoding(resp, encoding):
+    if encoding is not None:
+        resp.headers.set('Content-Encoding', encoding)
+    resp.headers.set('Vary', 'Accept-Encoding')
+    return resp
+
+
+def json_response(config, key, _query, _facetquery, _sort, _from, _bulksize, deadline=None, pretty=False, encodings=[]):
+    # Antwort berechnen und (wenn vollstaendig) mit der komprimierten
+    # Fassung fuer encodings im Antwort-Cache ablegen
+    R = search_json(config, _query, _facetquery, _sort, _from, _bulksize, deadline)
+    R["docs"] = list(R["docs"])
+    entry = CachedResponse(dump_json(R, pretty), R["info"]["total"])
+    entry.encode(encodings)
+    if not R["info"].get("partial"):
+        RESPONSE_CACHE.put(key, entry, ttl=config.get_cachettl())
+    return entry
+
+
+def stream_json(config, key, flight, _query, _facetquery, _sort, _from, _bulksize, deadline=None, encoding=None):
+    # Kompakte Antwort als Stream: alle Solr Anfragen laufen vorher, dann
+    # gehen info und facets sofort raus und jedes PNX Dokument, sobald es
+    # konvertiert ist. Das erste Dokument wird vor dem ersten Byte
+    # konvertiert, damit ein Fehler dabei noch eine 500 ergibt. Den Rest
+    # baut ein STREAM_EXECUTOR Thread unabhaengig vom Client fertig;
+    # gleichzeitige identische Anfragen warten auf diesen fertigen Body
+    # (SINGLEFLIGHT, Schluessel flight), der danach unter key in den
+    # Antwort-Cache geht. Ohne Cache und ohne Wartende wird kein Body
+    # gesammelt, im Speicher liegen nur die noch nicht gesendeten Teile.
+    (call, leader) = SINGLEFLIGHT.begin(flight)
+    if not leader:
+        return SINGLEFLIGHT.wait(call)
+    try:
+        R = search_json(config, _query, _facetquery, _sort, _from, _bulksize, deadline)
+        cacheable = not R["info"].get("partial") and config.get_cachettl() > 0
+        if not cacheable and SINGLEFLIGHT.release(flight, call):
+            call = None
+        parts  = json_parts(R)
+        stream = ResponseStream(key, cacheable or call is not None)
+        stream.add(next(parts))
+        stream.add(next(parts))
+    except BaseException as e:
+        if call is not None:
+            SINGLEFLIGHT.finish(flight, call, error=e)
+        raise
+    STREAM_EXECUTOR.submit(complete_stream, config, key, flight, call, R, parts, stream, cacheable)
+    # kleine Antworten bleiben unkomprimiert (COMPRESS_MIN_SIZE); meist
+    # reichen dafuer schon info, facets und das erste Dokument
+    if encoding is not None and not stream.reaches(COMPRESS_MIN_SIZE):
+        encoding = None
+    return CachedResponse(stream_body(stream, encoding, cacheable), R["info"]["total"], encoding)
+
+
+class ResponseStream:
+    # Teile einer gestreamten Antwort: complete_stream haengt an, der
+    # Client (stream_body) nimmt sie heraus, so schnell er kann. Mit keep
+    # wird zugleich der ganze Body gesammelt (io.BytesIO: getvalue()
+    # kopiert ihn am Ende nicht noch einmal).
+    def __init__(self, key, keep):
+        self.key    = key
+        self.parts  = collections.deque()
+        self.body   = io.BytesIO() if keep else None
+        self.size   = 0
+        self.entry  = None
+        self.error  = None
+        self.done   = False
+        self.closed = False      # Client weg: Teile nicht mehr aufheben
+        self._cond  = threading.Condition()
+
+    def add(self, part):
+        if self.body is not None:
+            self.body.write(part)
+        with self._cond:
+            if not self.closed:
+                self.parts.append(part)
+            self.size = self.size + len(part)
+            self._cond.notify_all()
+
+    def reaches(self, size):
+        # wartet, bis die Antwort size Bytes hat (True) oder fertig ist
+        with self._cond:
+            while self.size < size and not self.done:
+                self._cond.wait()
+            return self.size >= size
+
+    def close(self, entry=None, error=None):
+        with self._cond:
+            self.entry = entry
+            self.error = error
+            self.done  = True
+            self._cond.notify_all()
+
+    def __iter__(self):
+        try:
+            while True:
+                with self._cond:
+                    while not self.parts and not self.done:
+                        self._cond.wait()
+                    if not self.parts:
+                        if self.error is not None:
+                            raise self.error
+                        return
+                    part = self.parts.popleft()
+                yield part
+        finally:
+            with self._cond:
+                self.closed = True
+                self.parts.clear()
+
+
+def complete_stream(config, key, flight, call, R, parts, stream, cacheable):
+    log_request(config)
+    entry = None
+    error = None
+    try:
+        for part in parts:
+            stream.add(part)
+        if stream.body is not None:
+            entry = CachedResponse(stream.body.getvalue(), R["info"]["total"])
+            stream.body = None
+        if cacheable:
+            RESPONSE_CACHE.put(key, entry, ttl=config.get_cachettl())
+    except Exception as e:
+        # die Antwort laeuft schon (200), sie bricht hier ab
+        Log('Response stream failed: %s', e, level=logging.ERROR)
+        error = e
+    finally:
+        stream.close(entry, error)
+        if call is not None:
+            SINGLEFLIGHT.finish(flight, call, entry, error)
+
+
+def stream_body(stream, encoding=None, cacheable=False):
+    # encoding 'gzip': jedes Stueck komprimiert und mit Z_SYNC_FLUSH
+    # sofort gesendet; vollstaendig gesendet geht der gzip Body mit in
+    # den Cache-Eintrag (nur dann wird er gesammelt)
+    compressor = None
+    zipped     = None
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        if cacheable:
+            zipped = io.BytesIO()
+    for chunk in stream:
+        if compressor is not None:
+            chunk = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if zipped is not None:
+                zipped.write(chunk)
+        yield chunk
+    if compressor is not None:
+        chunk = compressor.flush()
+        yield chunk
+        if zipped is not None and stream.entry is not None:
+            zipped.write(chunk)
+            stream.entry.encoded['gzip'] = zipped.getvalue()
+            RESPONSE_CACHE.resize(stream.key, stream.entry)
+
+
+def json_parts(R):
+    # dieselben Bytes wie dump_json(R), Dokument fuer Dokument
+    yield b'{"info":' + dump_json(R["info"]) + b',"facets":' + dump_json(R["facets"]) + b',"docs":['
+    separator = b''
+    for pnx_doc in R["docs"]:
+        yield separator + dump_json(pnx_doc)
+        separator = b','
+    yield b']}'
+
+
+def prefetch_json(config, key, _query, _facetquery, _sort, _from, _bulksize, pretty=False):
+    log_request(config)
+    if RESPONSE_CACHE.contains(key):
+        return
+    Log('Prefetch from=%s bulksize=%s', _from, _bulksize)
+    # wie eine Anfrage ohne deadline Parameter (flight in do_json), aber
+    # hoechstens PREFETCH_DEADLINE: wird Solr waehrenddessen langsam, bricht
+    # der Prefetch ab (partial, nicht gecacht) statt Solr weiter zu belasten
+    deadline = min(config.get_deadline(), PREFETCH_DEADLINE)
+    SINGLEFLIGHT.do(key + (None,), json_response, config, key, _query, _facetquery, _sort, _from, _bulksize, deadline, pretty)
+
+
+def dump_json(R, pretty=False):
+    # JSON Body als bytes: eingerueckt und sortiert (wie bisher) oder
+    # kompakt, die Schluessel in der Reihenfolge, in der R aufgebaut wird.
+    # Kompakt mit orjson, wenn installiert; json liefert dieselben Bytes.
+    if pretty:
+        return json.dumps(R, indent=2, sort_keys=True).encode('utf-8')
+    if orjson is not None:
+        return orjson.dumps(R)
+    return json.dumps(R, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def search_json(config, _query, _facetquery, _sort, _from, _bulksize, deadline=None):
+        solr  = get_solr(config, SOLR_TIMEOUT_JSON)
+        solrs = [solr] + [get_solr(config, SOLR_TIMEOUT_JSON, [url]) for url in config.get_cores()]
+
+        ids = id_lookup(_query)
+        if ids is not None:
+            return lookup_json(config, solrs, ids, _facetquery, _from, _bulksize, deadline)
+
+        if len(solrs) > 1:
+            return federated_json(config, solrs, _query, _facetquery, _sort, _from, _bulksize, deadline)
+      
+        # Zweistufig: die Gruppen liefern nur die leichten Felder, die
+        # fullrecords der Gruppenkoepfe holt groups_to_pnx nach
+        fl = config.get_fl(JSON_FIELDS)
+        if config.get_fetchmode() == 'twophase':
+            fl = config.get_fl(JSON_GROUP_FIELDS)
+
+        # Unabhaengige Solr Anfragen laufen parallel bis zur Deadline
+        plan = SubRequests(deadline or config.get_deadline())
+      
+        # Facetten haengen nicht von from/bulksize/sort ab: eigene Anfrage,
+        # pro (Anfrage, Filter, Mandant) gecacht. Nicht kritisch, bei
+        # Ueberschreitung der Deadline bleiben sie leer.
+        facetkey = (config._section, _query, tuple(_facetquery))
+        Facets = FACET_CACHE.get(facetkey)
+        if Facets is None:
+            plan.submit('facets', search_facets, solr, _query, _facetquery, plan,
+                        critical=False, default=empty_facets())
+
+        if config.get_dedup() == 'collapse':
+            # Collapse/Expand: numFound zaehlt bereits die Gruppen (exakt)
+            plan.submit('groups', search_collapsed, solr, _query, _facetquery, _sort, _from, _bulksize, fl, plan)
+            results   = plan.result('groups')
+            total     = results.hits
+            grouplist = collapsed_groups(results)
+        else:
+            # Trefferzahl: COUNTMODE 'cached' zaehlt nur bei der ersten Seite
+            # einer Anfrage per cardinality, spaetere Seiten nehmen die
+            # gecachte Zahl
+            countmode = config.get_countmode()
+            total = None
+            if countmode == 'cached':
+                total = TOTAL_CACHE.get(facetkey)
+                countmode = 'cardinality' if total is None else None
+            plan.submit('groups', search_groups, solr, _query, _facetquery, _sort, _from, _bulksize, fl, countmode, plan)
+
+            results = plan.result('groups')
+      
+            Log("Matches: %s", results.grouped["test_matchkey_3"]["matches"])
+            if total is None:
+                total = count_total(results, countmode)
+                if config.get_countmode() == 'cached' and 'groups' not in plan.missed:
+                    TOTAL_CACHE.put(facetkey, total, ttl=FACET_CACHE_TTL)
+            grouplist = [g["doclist"]["docs"] for g in results.grouped["test_matchkey_3"]["groups"]]
+        Log("Total:   %s (%s)", total, config.get_countmode())
       
-        # De-Duplication
-        # _facetquery.append('{!collapse field=test_matchkey_3 }')
-        # _facetquery.append('{!collapse field=test_matchkey_3 max=publish_date_sort}')
+        R = {}
+        # R["info"]   = { "total":results.hits, "last":_from+len(results), "first":_from+1 }
+        # R["info"]   = { "total":results.grouped["test_matchkey_3"]["matches"], "last":_from+len(results), "first":_from+1 }
+        # last: Gruppen dieser Seite, in beiden Modi (len(results) ist bei
+        # group immer 0, pysolr liefert dort keine docs)
+        R["info"]   = { "total":total, "last":_from+len(grouplist), "first":_from+1 }
         
+        if Facets is None:
+            Facets = plan.result('facets')
+            if 'facets' not in plan.missed:
+                FACET_CACHE.put(facetkey, Facets, ttl=FACET_CACHE_TTL)
+        R["facets"] = Facets
         
-        results = solr.search(_query, rows=_bulksize, start=_from, 
-               **{ 'group': 'true',                     # grouping ein
-                   'group.field': 'test_matchkey_3',    #
-                   'group.limit': 10,                   #
-                   'group.ngroups': 'false',            #
-                   # groups zaehlen 
-                   'stats': 'true',
-                   'stats.field': '{!cardinality=true}test_matchkey_3',
+        R["docs"] = pnx_stream(config, solr, grouplist, plan)
+        if plan.missed != []:
+            R["info"]["partial"] = True
+        return R
+
+
+def federated_json(config, solrs, _query, _facetquery, _sort, _from, _bulksize, deadline=None):
+    # Foederierte Suche: dieselbe Anfrage parallel an alle Cores, jeder
+    # liefert die ersten from+bulksize Gruppen. Gemischt wird nach score
+    # bzw. dem Sortierfeld, Dubletten ueber die Cores hinweg (gleicher
+    # test_matchkey_3, sonst gleiche id) werden zu einer Gruppe.
+    # Der erste Core (GVIURLS) ist kritisch, die weiteren nicht.
+    # Mehr als FEDERATED_MAX_ROWS Gruppen gibt es nicht, total wird
+    # darauf begrenzt, damit Primo nicht weiter blaettert.
+    plan = SubRequests(deadline or config.get_deadline())
+    rows = min(_from + _bulksize, FEDERATED_MAX_ROWS)
+    group_fields = JSON_FIELDS
+    if config.get_fetchmode() == 'twophase':
+        group_fields = JSON_GROUP_FIELDS
+    fields = group_fields + ['test_matchkey_3', 'score']
+    if _sort != '':
+        fields = fields + [_sort.split()[0]]
+    fl = config.get_fl(fields)
+
+    facetkey = (config._section, _query, tuple(_facetquery))
+    Facets = FACET_CACHE.get(facetkey)
+    countmode = config.get_countmode()
+    total = None
+    if countmode == 'cached':
+        total = TOTAL_CACHE.get(facetkey)
+        countmode = 'cardinality' if total is None else None
+    for (i, solr) in enumerate(solrs):
+        if Facets is None:
+            plan.submit('facets%s' % i, search_facets, solr, _query, _facetquery, plan,
+                        critical=False, default=None)
+        plan.submit('groups%s' % i, search_groups, solr, _query, _facetquery, _sort, 0, rows, fl, countmode, plan,
+                    critical=(i == 0), default=None)
+
+    grouplists = []
+    counts = []
+    origin = {}    # id -> Core, der das Dokument geliefert hat
+    for i in range(len(solrs)):
+        results = plan.result('groups%s' % i)
+        if results is None:
+            continue
+        grouplists.append(results.grouped["test_matchkey_3"]["groups"])
+        for g in grouplists[-1]:
+            for doc in g["doclist"]["docs"]:
+                origin.setdefault(doc["id"], i)
+        if total is None:
+            counts.append(count_total(results, countmode))
+    if total is None:
+        # Dubletten zwischen den Cores werden doppelt gezaehlt
+        total = sum(counts)
+        if config.get_countmode() == 'cached' and plan.missed == []:
+            TOTAL_CACHE.put(facetkey, total, ttl=FACET_CACHE_TTL)
+    total = min(total, FEDERATED_MAX_ROWS)
+    grouplist = merge_groups(grouplists, _sort)[_from:_from+_bulksize]
+    Log("Total:   %s (%s, %s cores)", total, config.get_countmode(), len(solrs))
+    if config.get_fetchmode() == 'twophase':
+        fetch_fullrecords(config, solrs, grouplist, origin, plan)
+
+    R = {}
+    R["info"]   = { "total":total, "last":_from+len(grouplist), "first":_from+1 }
+    if Facets is None:
+        Facets = merge_facets([f for f in [plan.result('facets%s' % i) for i in range(len(solrs))] if f is not None])
+        if plan.missed == []:
+            FACET_CACHE.put(facetkey, Facets, ttl=FACET_CACHE_TTL)
+    R["facets"] = Facets
+    R["docs"]   = pnx_stream(config, solrs[0], grouplist, plan)
+    if plan.missed != []:
+        R["info"]["partial"] = True
+    return R
+
+
+def fetch_fullrecords(config, solrs, grouplist, origin, plan):
+    # Zweistufig foederiert: die fullrecords der Gruppenkoepfe kommen von
+    # dem Core, der den Kopf geliefert hat, parallel je Core. Koepfe im
+    # PNX Cache brauchen keinen.
+    heads = {}
+    for docs in grouplist:
+        key = (docs[0]["id"], config._section, hash(tuple(group_institutions(docs))))
+        if "fullrecord" not in docs[0] and not PNX_CACHE.contains(key):
+            heads[docs[0]["id"]] = docs[0]
+    names = []
+    for (i, solr) in enumerate(solrs):
+        ids = [id for id in heads if origin.get(id) == i]
+        if ids != []:
+            plan.submit('fullrecords%s' % i, fetch_docs, solr, ids, 'id,fullrecord', [], plan,
+                        critical=(i == 0), default={})
+            names.append('fullrecords%s' % i)
+    for name in names:
+        for (id, r) in plan.result(name).items():
+            if r.get("fullrecord") is not None:
+                heads[id]["fullrecord"] = r["fullrecord"]
+
+
+def merge_groups(grouplists, _sort):
+    # Gruppen mehrerer Cores in eine Liste: nach score absteigend oder nach
+    # dem Sortierfeld (fehlende Werte zuletzt), bei Gleichstand in der
+    # Reihenfolge der Cores. Gruppen mit gleichem Schluessel werden
+    # zusammengefasst, die besser platzierte liefert den Gruppenkopf.
+    groups = []
+    for grouplist in grouplists:
+        for g in grouplist:
+            docs = g["doclist"]["docs"]
+            if docs != []:
+                groups.append((g["groupValue"] or docs[0]["id"], docs))
+    if _sort == '':
+        groups.sort(key=lambda g: g[1][0].get("score", 0), reverse=True)
+    else:
+        (field, direction) = _sort.split()[:2]
+        present = [g for g in groups if g[1][0].get(field) is not None]
+        present.sort(key=lambda g: sort_value(g[1][0][field]), reverse=(direction == 'desc'))
+        groups = present + [g for g in groups if g[1][0].get(field) is None]
+
+    merged = collections.OrderedDict()
+    for (key, docs) in groups:
+        if key in merged:
+            ids = set(d["id"] for d in merged[key])
+            merged[key] = (merged[key] + [d for d in docs if d["id"] not in ids])[:10]
+        else:
+            merged[key] = docs
+    return list(merged.values())
+
+
+def sort_value(value):
+    if isinstance(value, list):
+        return value[0]
+    return value
+
+
+def merge_facets(facetlists):
+    # Facettenwerte mehrerer Cores addieren, je Facette die 10 haeufigsten
+    Facets = empty_facets()
+    for (i, facet) in enumerate(Facets):
+        counts = collections.OrderedDict()
+        for facets in facetlists:
+            for v in facets[i]["values"]:
+                counts[v["value"]] = counts.get(v["value"], 0) + v["count"]
+        values = sorted(counts.items(), key=lambda v: v[1], reverse=True)[:10]
+        facet["values"] = [{"count":count, "value":value } for (value, count) in values]
+    return Facets
+
+
+def search_groups(solr, _query, _facetquery, _sort, _from, _bulksize, fl, countmode, plan):
+    # De-Duplication
+    # _facetquery.append('{!collapse field=test_matchkey_3 }')
+    # _facetquery.append('{!collapse field=test_matchkey_3 max=publish_date_sort}')
+        
+    params = { 'group': 'true',                     # grouping ein
+               'group.field': 'test_matchkey_3',    #
+               'group.limit': 10,                   #
+               'sort' : _sort,
+               'fl' : fl,
+               'hl' : 'false',
+               'mm' : SOLR_MM,
+               'qf' : SOLR_QF,
+               'spellcheck' : 'false',
+               'defType' : SOLR_DEFTYPE,
+               'shards.tolerant': 'true',
+               'fq' : _facetquery,
+               'q.op' : 'AND' }
+    # groups zaehlen
+    params.update(COUNT_PARAMS.get(countmode, {}))
+    plan.limit(params)
+    return plan.check('groups', solr.search(_query, rows=_bulksize, start=_from, **params))
+
+
+def search_collapsed(solr, _query, _facetquery, _sort, _from, _bulksize, fl, plan):
+    # De-Duplication per collapse, die Dubletten der Gruppenkoepfe liefert expand
+    results = solr.search(_query, rows=_bulksize, start=_from,
+               **plan.limit({ 'expand' : 'true',
+                   'expand.rows' : 9,                   # wie group.limit 10
                    'sort' : _sort,
-                   'fl' : '*,score',
+                   'fl' : fl + ',test_matchkey_3',
                    'hl' : 'false',
+                   'mm' : SOLR_MM,
+                   'qf' : SOLR_QF,
+                   'spellcheck' : 'false',
+                   'defType' : SOLR_DEFTYPE,
+                   'shards.tolerant': 'true',
+                   'fq' : _facetquery + [COLLAPSE_FQ],
+                   'q.op' : 'AND' } ))
+    return plan.check('groups', results)
+
+
+def collapsed_groups(results):
+    # Gruppen wie bei group=true: Gruppenkopf gefolgt von den Dubletten
+    expanded = results.raw_response.get("expanded", {})
+    grouplist = []
+    for head in results.docs:
+        docs = [head]
+        matchkey = head.get("test_matchkey_3")
+        if matchkey in expanded:
+            docs = docs + expanded[matchkey]["docs"]
+        grouplist.append(docs)
+    return grouplist
+
+
+def count_total(results, countmode):
+    if countmode == 'cardinality':
+        return results.stats["stats_fields"]["test_matchkey_3"]["cardinality"]
+    if countmode == 'ngroups':
+        return results.grouped["test_matchkey_3"]["ngroups"]
+    return results.grouped["test_matchkey_3"]["matches"]
+
+
+def empty_facets():
+    return [ { "name":pnx_facet_name, "values":[] } for pnx_facet_name in FACET_MAP.keys() ]
+
+
+def search_facets(solr, _query, _facetquery, plan):
+    # Facetten ohne Treffer und ohne Gruppierung (rows=0)
+    results = solr.search(_query, rows=0,
+               **plan.limit({ 'hl' : 'false',
                    'mm' : SOLR_MM,
                    'qf' : SOLR_QF,
                    'spellcheck' : 'false',
@@ -913,82 +2351,317 @@ def do_json():
                    'facet.sort': 'count',
                    'facet.threads' : 4,
                    'facet.limit' : 10, 
-                   'facet.field' : FACET_MAP.values() } )
-      
-        Log ("Matches: %s" % results.grouped["test_matchkey_3"]["matches"])      
-        Log ("Stats:   %s" % results.stats["stats_fields"]["test_matchkey_3"]["cardinality"])      
-      
-        R = json.loads("""{}""")
-        # R["info"]   = { "total":results.hits, "last":_from+len(results), "first":_from+1 }
-        # R["info"]   = { "total":results.grouped["test_matchkey_3"]["matches"], "last":_from+len(results), "first":_from+1 }
-        R["info"]   = { "total":results.stats["stats_fields"]["test_matchkey_3"]["cardinality"], "last":_from+len(results), "first":_from+1 }
-        R["docs"]   = []
-        R["facets"] = []
-        
-        Facets = R["facets"]
-        
-      
-        
-        for pnx_facet_name in FACET_MAP.keys():
-            i=0
-            facet_name = FACET_MAP[pnx_facet_name]
-            Facets.append( { "name":pnx_facet_name, "values":[] })
-            while i<len(results.facets["facet_fields"][facet_name]):
-                value=results.facets["facet_fields"][facet_name][i]
-                count=results.facets["facet_fields"][facet_name][i+1]
-                if count>0 and (pnx_facet_name != 'facet_lang' or value != 'und'):
-                    Facets[-1]["values"].append({"count":count, "value":value })
-                i=i+2
-        
-        
+                   'facet.field' : FACET_MAP.values() } ))
+    plan.check('facets', results)
+
+    Facets = []
         
-        doclist = R["docs"]
-        number = 0
-        # for result in results:
-        groups = results.grouped["test_matchkey_3"]["groups"]
-        for groupedresult in groups:
-            gvi_id_list = []
-            pnx_institutions = []
-            docnumber = 0
-            for r in groupedresult["doclist"]["docs"]:
-                gvi_id_list.append(r["id"])
-                # if True:
-                if "DE-576" in r["consortium"]:
-                    # pnx_institutions.append(r["consortium"])
-                    pnx_institutions.append("DE-576")
-                    pnx_institutions.append(r["id"])
-                    pnx_institutions = pnx_institutions + r["institution_id"]
-            Log("result: %i" % number)
-            # Log(result)
-            result = groupedresult["doclist"]["docs"][docnumber]
-            gvi_id = result["id"]
-            pnx_sourcerecordid = gvi_id[8:]
-            pnx_sourcesystem = gvi_id[1:3]+gvi_id[4:7]
-            pnx_recordid = "%s_%s" % (pnx_sourcesystem, pnx_sourcerecordid)
-            pnx_type     = result["material_content_type"][0].lower()
-            pnx_language = result["language"][0].lower()
-            marcxml  = result["fullrecord"]
-            marcfile = io.StringIO(marcxml)
-            reclist  = parse_xml_to_array(marcfile)
-            record   = reclist[0]
-            Log('Inst: %s' % pnx_institutions)
-            doclist.append(marc_to_pnx(
-                gvi_id, pnx_sourcerecordid, pnx_sourcesystem, pnx_recordid, pnx_type, 
-                pnx_language, pnx_institutions, delcategory,
-                link_templates, openurl_templates, baseurl_templates, isils,
-                record,
-                config._debug) )    
-            # doclist.append(pnx_doc)    
-            number = number + 1
-        if FLAG:
-            Log("\nPNX/json:\n%s" % R)
+    for pnx_facet_name in FACET_MAP.keys():
+        i=0
+        facet_name = FACET_MAP[pnx_facet_name]
+        Facets.append( { "name":pnx_facet_name, "values":[] })
+        while i<len(results.facets["facet_fields"][facet_name]):
+            value=results.facets["facet_fields"][facet_name][i]
+            count=results.facets["facet_fields"][facet_name][i+1]
+            if count>0 and (pnx_facet_name != 'facet_lang' or value != 'und'):
+                Facets[-1]["values"].append({"count":count, "value":value })
+            i=i+2
+    return Facets
+
+
+def group_institutions(docs):
+    pnx_institutions = []
+    for r in docs:
+        # if True:
+        if "DE-576" in r["consortium"]:
+            # pnx_institutions.append(r["consortium"])
+            pnx_institutions.append("DE-576")
+            pnx_institutions.append(r["id"])
+            pnx_institutions = pnx_institutions + r["institution_id"]
+    return pnx_institutions
+
+
+def groups_to_pnx(config, solr, grouplist, plan=None):
+    return list(pnx_stream(config, solr, grouplist, plan))
+
+
+def pnx_stream(config, solr, grouplist, plan=None):
+    # grouplist: je Gruppe die Dubletten, der erste Treffer liefert den
+    # fullrecord. Fehlt er (zweistufiger Abruf), werden alle fehlenden
+    # fullrecords mit einer Anfrage nachgeladen, aber nur fuer Gruppen,
+    # die nicht schon im PNX Cache sind. Die Solr Anfrage laeuft sofort,
+    # konvertiert wird erst beim Iterieren des Ergebnisses.
+    pnx_docs = []
+    todo     = []
+    for docs in grouplist:
+        pnx_institutions = group_institutions(docs)
+        key = (docs[0]["id"], config._section, hash(tuple(pnx_institutions)))
+        pnx_doc = PNX_CACHE.get(key)
+        if pnx_doc is None:
+            todo.append((len(pnx_docs), docs[0], pnx_institutions, key))
         else:
-            resp = make_response(json.dumps(R, indent=2, sort_keys=True))
-    #except:
-            #resp=make_response("{ }")
-            resp.headers.set('Content-type', 'application/json')
-            return resp
-    
+            Log('PNX cache hit: %s', docs[0]["id"])
+        pnx_docs.append(pnx_doc)
+
+    missing = [result["id"] for (i, result, pnx_institutions, key) in todo if "fullrecord" not in result]
+    fullrecords = {}
+    if missing != []:
+        for (id, r) in fetch_docs(solr, missing, 'id,fullrecord', plan=plan).items():
+            fullrecords[id] = r.get("fullrecord")
+    return convert_pnx(config, pnx_docs, todo, fullrecords)
+
+
+def convert_pnx(config, pnx_docs, todo, fullrecords):
+    todo = dict((i, (result, pnx_institutions, key)) for (i, result, pnx_institutions, key) in todo)
+    for (i, pnx_doc) in enumerate(pnx_docs):
+        if i in todo:
+            (result, pnx_institutions, key) = todo[i]
+            fullrecord = result.get("fullrecord") or fullrecords.get(result["id"])
+            if fullrecord is None:
+                Log('No fullrecord for %s', result["id"], level=logging.WARNING)
+                continue
+            pnx_doc = record_to_pnx(config, result, fullrecord, pnx_institutions)
+            PNX_CACHE.put(key, pnx_doc, ttl=PNX_CACHE_TTL)
+        yield pnx_doc
+
+
+def fetch_docs(solr, ids, fl, fq=[], plan=None):
+    # Solr Dokumente zu einer Liste von GVI ids mit einer {!terms} Anfrage,
+    # Ergebnis id -> Dokument (nicht gefundene ids fehlen)
+    params = { 'fl' : fl,
+               'fq' : fq,
+               'hl' : 'false',
+               'spellcheck' : 'false',
+               'shards.tolerant': 'true' }
+    if plan is not None:
+        plan.limit(params)
+    results = solr.search('{!terms f=id}%s' % ','.join(ids), rows=len(ids), **params)
+    if plan is not None:
+        plan.check('fullrecords', results)
+    Log('Fetched %s of %s ids', len(results.docs), len(ids))
+    return dict((r["id"], r) for r in results.docs)
+
+
+def id_lookup(query):
+    # GVI ids einer reinen id Suche, wie sie rewrite_parameters fuer die
+    # Vollanzeige in Primo erzeugt: id:"..." oder id:("..." OR "..."),
+    # auch id:"..." OR id:"...". Sonst None.
+    ids = []
+    grouped = False
+    for term in re.split(' +OR +', query.strip()):
+        m = ID_TERM_PATTERN.match(term)
+        if m is None or (m.group(1) == '' and not grouped):
+            return None
+        if m.group(1) != '' and m.group(2) == '(':
+            grouped = True
+        if m.group(4) != '':
+            # ")" schliesst id:( ... ), danach braucht jeder Term wieder id:
+            grouped = False
+        ids.append(m.group(3))
+    return ids
+
+
+def lookup_json(config, solrs, ids, _facetquery, _from, _bulksize, deadline=None):
+    # Schneller Weg fuer id Suchen: {!terms} Anfrage ohne edismax,
+    # Gruppierung, Statistik und Facetten. Foederiert werden die weiteren
+    # Cores nur nach den ids gefragt, die die vorigen nicht kannten.
+    # Es gilt dieselbe Deadline wie fuer die Suche.
+    Log('ID lookup: %s', ids)
+    plan  = SubRequests(deadline or config.get_deadline())
+    found = {}
+    for (i, solr) in enumerate(solrs):
+        todo = [id for id in ids if id not in found]
+        if todo == []:
+            break
+        plan.submit('lookup%s' % i, fetch_docs, solr, todo, config.get_fl(JSON_FIELDS), _facetquery, plan,
+                    critical=(i == 0), default={})
+        found.update(plan.result('lookup%s' % i))
+    groups = [[found[id]] for id in ids if id in found][_from:_from+_bulksize]
+    R = {}
+    R["info"]   = { "total":len(found), "last":_from+len(groups), "first":_from+1 }
+    R["facets"] = empty_facets()
+    R["docs"]   = pnx_stream(config, solrs[0], groups, plan)
+    if plan.missed != []:
+        R["info"]["partial"] = True
+    return R
+
+
+def record_to_pnx(config, result, fullrecord, pnx_institutions):
+    gvi_id = result["id"]
+    pnx_sourcerecordid = gvi_id[8:]
+    pnx_sourcesystem = gvi_id[1:3]+gvi_id[4:7]
+    pnx_recordid = "%s_%s" % (pnx_sourcesystem, pnx_sourcerecordid)
+    pnx_type     = result["material_content_type"][0].lower()
+    pnx_language = result["language"][0].lower()
+    record   = parse_marcxml(fullrecord, PNX_TAGS)
+    Log('Inst: %s', pnx_institutions)
+    return marc_to_pnx(
+        gvi_id, pnx_sourcerecordid, pnx_sourcesystem, pnx_recordid, pnx_type, 
+        pnx_language, pnx_institutions, config.get_delcategory(),
+        config.get_links(), config.get_openurls(), config.get_baseurls(), config.get_isils(),
+        record,
+        config._debug)
+
+
+# -----------------------------------------------------------------
+# Batch API: PNX zu einer Liste bekannter GVI ids
+#
+# POST mit JSON { "token": "...", "ids": [ "(DE-627)...", ... ] },
+# optional "deadline" (Sekunden, wie bei /json)
+# Antwort wie /json, docs in der Reihenfolge der ids, nicht gefundene
+# ids (auch durch die Filter des Mandanten oder ohne fullrecord) in
+# info.missing
+#
+# Aufruf in wsgi.py:
+#    @app.route('/json/batch', methods=['POST'])
+# -----------------------------------------------------------------
+
+def do_batch():
+    log_request()
+    Log('\n\n\nNew Batch Request: %s \n-----------', datetime.datetime.now(), level=logging.INFO)
+    body   = request.get_json(silent=True)
+    if body is None:
+        body = {}
+    if not isinstance(body, dict):
+        resp=make_response("{ }", 400)
+        resp.headers.set('Content-type', 'application/json')
+        return resp
+    _token = body.get('token') or request.args.get('token')
+    ids    = body.get('ids')
+    _deadline = body.get('deadline')
+    if not isinstance(_deadline, (int, float)):
+        _deadline = get_number(request.args, 'deadline', float)
+
+    config = get_config(_token)
+    log_request(config)
+    if not config.validate(_token) or not isinstance(ids, list) or len(ids) > BATCH_MAX_IDS:
+        resp=make_response("{ }", 400)
+        resp.headers.set('Content-type', 'application/json')
+        return resp
+    ids = [str(id) for id in ids]
+    Log("Batch: %s ids, Token: %s", len(ids), _token, level=logging.INFO)
+
+    solr   = get_solr(config, SOLR_TIMEOUT_JSON)
+    plan   = SubRequests(config.get_deadline(_deadline))
+    found  = {}
+    if ids != []:
+        # dieselben Filter wie /json (JSON_FILTERS, FILTERS des Mandanten),
+        # herausgefilterte ids sind missing
+        FQ = JSON_FILTERS + config.get_filters()
+        plan.submit('lookup', fetch_docs, solr, list(dict.fromkeys(ids)), config.get_fl(JSON_FIELDS), FQ, plan)
+        try:
+            found = plan.result('lookup')
+        except concurrent.futures.TimeoutError:
+            return deadline_response(config.get_deadline(_deadline))
+    # ohne fullrecord kein PNX: auch diese ids sind missing
+    found   = dict((id, doc) for (id, doc) in found.items() if doc.get("fullrecord"))
+    missing = [id for id in ids if id not in found]
+
+    R = {}
+    R["info"] = { "total":len(ids)-len(missing), "missing":missing }
+    R["docs"] = groups_to_pnx(config, solr, [[found[id]] for id in ids if id in found], plan)
+    if plan.missed != []:
+        R["info"]["partial"] = True
+    resp = make_response(dump_json(R, config._debug or request.args.get('pretty') == 'true'))
+    resp.headers.set('Content-type', 'application/json')
+    return resp
+
+# -----------------------------------------------------------------
+# Export: alle Treffer einer Anfrage als PNX, ein JSON Dokument pro
+# Zeile (application/x-ndjson), ohne from/bulksize Grenzen
+#
+# Aufruf in wsgi.py:
+#    @app.route('/json/export')
+# -----------------------------------------------------------------
+
+def do_export():
+    log_request()
+    Log('\n\n\nNew Export Request: %s \n-----------', datetime.datetime.now(), level=logging.INFO)
+    _query = request.args.get('query')
+    _sort  = request.args.get('sort')
+    _token = request.args.get('token')
+
+    config = get_config(_token)
+    log_request(config)
+    if not config.validate(_token) or _query is None:
+        resp=make_response("{ }")
+        resp.headers.set('Content-type', 'application/json')
+        return resp
+
+    FQ = JSON_FILTERS + config.get_filters()
+    _query, _facetquery, _sort, _from, _bulksize = rewrite_parameters(_query, FQ, _sort, None, None)
+    Log("Export: Query: %s Sort: %s Token: %s", _query, _sort, _token, level=logging.INFO)
+
+    solr = get_solr(config, SOLR_TIMEOUT_JSON)
+    return Response(stream_with_context(export_pnx(config, solr, _query, _facetquery, _sort)),
+                    mimetype='application/x-ndjson')
+
+
+def export_pnx(config, solr, _query, _facetquery, _sort):
+    # Blaettern per cursorMark (Sortierung muss auf id enden), Dubletten per
+    # collapse/expand. Die naechste Seite wird erst geholt, wenn der Client
+    # die vorige gelesen hat; es liegt immer nur eine Seite im Speicher.
+    # Die PNX Dokumente gehen nicht in den PNX_CACHE.
+    sort   = 'id asc' if _sort == '' else '%s, id asc' % _sort
+    cursor = '*'
+    count  = 0
+    while True:
+        try:
+            results = search_export(solr, _query, _facetquery, sort, cursor, config.get_fl(JSON_FIELDS))
+            pnx_docs = []
+            for docs in collapsed_groups(results):
+                fullrecord = docs[0].get("fullrecord")
+                if fullrecord is not None:
+                    pnx_docs.append(record_to_pnx(config, docs[0], fullrecord, group_institutions(docs)))
+        except Exception as e:
+            # Der Status (200) ist schon gesendet: eine letzte Zeile mit
+            # "error" und Abbruch der Uebertragung (ohne abschliessenden
+            # Chunk), damit der Client den Export als unvollstaendig erkennt
+            Log('Export failed after %s documents: %r', count, e, level=logging.ERROR)
+            yield dump_json({ "error":"export incomplete", "exported":count }) + b'\n'
+            raise
+        for pnx_doc in pnx_docs:
+            count = count + 1
+            yield dump_json(pnx_doc) + b'\n'
+        if results.nextCursorMark is None or results.nextCursorMark == cursor:
+            break
+        cursor = results.nextCursorMark
+    Log('Export: %s documents', count, level=logging.INFO)
+
+
+def search_export(solr, _query, _facetquery, sort, cursor, fl):
+    return solr.search(_query, rows=EXPORT_ROWS, start=0,
+               **{ 'cursorMark' : cursor,
+                   'expand' : 'true',
+                   'expand.rows' : 9,
+                   'sort' : sort,
+                   'fl' : fl + ',test_matchkey_3',
+                   'hl' : 'false',
+                   'mm' : SOLR_MM,
+                   'qf' : SOLR_QF,
+                   'spellcheck' : 'false',
+                   'defType' : SOLR_DEFTYPE,
+                   'fq' : _facetquery + [COLLAPSE_FQ],
+                   'q.op' : 'AND' } )
+
+# -----------------------------------------------------------------
+# Cache- und Pool-Statistik des Worker-Prozesses, nur mit dem Token
+# eines Mandanten (enthaelt die internen Solr URLs)
+#
+# Aufruf in wsgi.py:
+#    @app.route('/stats')
+# -----------------------------------------------------------------
+
+def do_stats():
+    _token = request.args.get('token')
+    if not get_config(_token).validate(_token):
+        resp=make_response("{ }", 403)
+        resp.headers.set('Content-type', 'application/json')
+        return resp
+    resp = make_response(json.dumps(get_stats(), indent=2, sort_keys=True))
+    resp.headers.set('Content-type', 'application/json')
+    return resp
+
 if __name__ == "__main__":
     FLAG = True
     logging.basicConfig(
@@ -0,0 +1,32 @@
+# id_lookup: welche Anfragen den schnellen Weg ueber {!terms f=id} nehmen
+
+import os, sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gvi2pnx
+
+
+@pytest.mark.parametrize('query, ids', [
+    ('id:"(DE-627)1"',                            ['(DE-627)1']),
+    ('((id:"(DE-627)1"))',                        ['(DE-627)1']),
+    ('id:("(DE-627)1" OR "(DE-576)2")',           ['(DE-627)1', '(DE-576)2']),
+    ('(id:("(DE-627)1" OR "(DE-576)2"))',         ['(DE-627)1', '(DE-576)2']),
+    ('id:"(DE-627)1" OR id:"(DE-576)2"',          ['(DE-627)1', '(DE-576)2']),
+    ('id:("(DE-627)1") OR id:("(DE-576)2")',      ['(DE-627)1', '(DE-576)2']),
+    ])
+def test_id_query(query, ids):
+    assert gvi2pnx.id_lookup(query) == ids
+
+
+@pytest.mark.parametrize('query', [
+    '((Geschichte))',
+    '"(DE-627)1"',
+    'id:"(DE-627)1" OR "(DE-576)2"',
+    'id:("(DE-627)1" OR "(DE-576)2") OR "(DE-601)3"',
+    'id:"(DE-627)1" AND id:"(DE-576)2"',
+    'title:"(DE-627)1"',
+    ])
+def test_other_query(query):
+    assert gvi2pnx.id_lookup(query) is None
@@ -0,0 +1,94 @@
+# LRUCache: TTL, Verdraengung nach Anzahl und Bytes, resize()
+
+import os, sys, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gvi2pnx
+
+
+class Entry:
+    # Wert mit size Attribut, wie CachedResponse
+    def __init__(self, size):
+        self.size = size
+
+
+def test_lru_order():
+    cache = gvi2pnx.LRUCache(2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    assert cache.get('b') is None
+    assert (cache.get('a'), cache.get('c')) == (1, 3)
+    assert cache.evictions == 1
+
+
+def test_ttl_expiry():
+    cache = gvi2pnx.LRUCache(10)
+    cache.put('short', 1, ttl=0.05)
+    cache.put('long', 2, ttl=60)
+    cache.put('never', 3)
+    assert cache.contains('short')
+    time.sleep(0.1)
+    assert not cache.contains('short')
+    assert cache.get('short') is None
+    assert (cache.get('long'), cache.get('never')) == (2, 3)
+    assert cache.stats()['expirations'] == 1
+    assert cache.stats()['entries'] == 2
+
+
+def test_ttl_zero_is_not_cached():
+    cache = gvi2pnx.LRUCache(10)
+    cache.put('a', 1, ttl=0)
+    assert cache.get('a') is None
+    assert cache.stats()['entries'] == 0
+
+
+def test_byte_limit():
+    cache = gvi2pnx.LRUCache(10, maxbytes=10)
+    cache.put('a', b'aaaa')
+    cache.put('b', b'bbbb')
+    assert cache.get('a') == b'aaaa'
+    cache.put('c', Entry(4))
+    # b ist am laengsten unbenutzt
+    assert cache.get('b') is None
+    assert cache.stats()['bytes'] == 8
+    # groesser als maxbytes: gar nicht gespeichert, nichts verdraengt
+    cache.put('big', b'x' * 11)
+    assert not cache.contains('big')
+    assert cache.stats()['entries'] == 2
+
+
+def test_replace_counts_once():
+    cache = gvi2pnx.LRUCache(10, maxbytes=10)
+    cache.put('a', b'aaaa')
+    cache.put('a', b'aaaaaa')
+    assert cache.stats()['bytes'] == 6
+    assert cache.stats()['entries'] == 1
+
+
+def test_resize():
+    cache = gvi2pnx.LRUCache(10, maxbytes=10)
+    (a, b) = (Entry(4), Entry(4))
+    cache.put('a', a)
+    cache.put('b', b)
+    b.size = 5
+    cache.resize('b', b)
+    assert cache.stats()['bytes'] == 9
+    # gewachsen ueber maxbytes: der aelteste Eintrag geht
+    b.size = 7
+    cache.resize('b', b)
+    assert not cache.contains('a')
+    assert cache.stats()['bytes'] == 7
+
+
+def test_resize_ignores_replaced_value():
+    cache = gvi2pnx.LRUCache(10, maxbytes=10)
+    old = Entry(2)
+    cache.put('a', old)
+    cache.put('a', Entry(3))
+    old.size = 9
+    cache.resize('a', old)
+    cache.resize('missing', old)
+    assert cache.stats()['bytes'] == 3
+    assert cache.stats()['entries'] == 1
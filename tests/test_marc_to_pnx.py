@@ -0,0 +1,52 @@
+# marc_to_pnx (parse_marcxml + PNX_FIELD_HANDLERS) gegen die Ausgabe des
+# frueheren Wegs ueber pymarc.parse_xml_to_array und die if-Kette pro Feld.
+#
+# data/marcxml.jsonl: MARCXML Korpus (id, material_content_type, fullrecord)
+# data/pnx_golden.json: PNX der frueheren marc_to_pnx zu diesem Korpus,
+#                       ohne und mit debug_flag
+
+import io, json, os, sys
+
+import pytest
+from pymarc import parse_xml_to_array
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gvi2pnx
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+LINKS    = [('https://portal.kobv.de/uid.do?index=gvi&query=%s', 'KOBV-Portal')]
+BASEURLS = [('https://primo.fu-berlin.de/openurl/49KOBV_FUB/49KOBV_FUB:FUB', 'U-Resolver FU-Berlin')]
+ISILS    = [('DE-180', 'UB Mannheim'), ('DE-188', 'UB FU Berlin')]
+
+
+def load_corpus():
+    with open(os.path.join(DATA, 'marcxml.jsonl'), encoding='utf-8') as f:
+        return dict((doc["id"], doc) for doc in map(json.loads, f))
+
+def load_golden():
+    with open(os.path.join(DATA, 'pnx_golden.json'), encoding='utf-8') as f:
+        return json.load(f)
+
+CORPUS = load_corpus()
+GOLDEN = load_golden()
+
+
+@pytest.mark.parametrize('doc', list(CORPUS.values()), ids=list(CORPUS))
+def test_parse_marcxml(doc):
+    old = parse_xml_to_array(io.StringIO(doc["fullrecord"]))[0]
+    new = gvi2pnx.parse_marcxml(doc["fullrecord"])
+    assert new.as_dict() == old.as_dict()
+
+
+@pytest.mark.parametrize('golden', GOLDEN, ids=['%s-%s' % (g["id"], g["debug"]) for g in GOLDEN])
+def test_marc_to_pnx(golden):
+    doc = CORPUS[golden["id"]]
+    gid = doc["id"]
+    sourcesystem = gid[1:3] + gid[4:7]
+    record = gvi2pnx.parse_marcxml(doc["fullrecord"], gvi2pnx.PNX_TAGS)
+    pnx = gvi2pnx.marc_to_pnx(gid, gid[8:], sourcesystem, "%s_%s" % (sourcesystem, gid[8:]),
+                              doc["material_content_type"][0].lower(), 'ger',
+                              ['DE-576', gid, '(DE-627)1234', 'DE-180', 'DE-188'], 'Structured Metadata',
+                              LINKS, [], BASEURLS, ISILS, record, golden["debug"])
+    assert json.loads(json.dumps(pnx)) == golden["pnx"]
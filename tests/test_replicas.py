@@ -0,0 +1,160 @@
+# Failover, Zweitanfragen (hedging) und Sperre der Solr Replicas gegen
+# kleine http.server Attrappen statt eines echten Solr
+
+import json, os, sys, threading, time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gvi2pnx
+
+
+class FakeSolr:
+    # antwortet auf /select mit einem Treffer, status/delay sind aenderbar
+    def __init__(self, name):
+        self.name   = name
+        self.status = 200
+        self.delay  = 0.0
+        self.hits   = 0
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                fake.hits = fake.hits + 1
+                time.sleep(fake.delay)
+                body = json.dumps({ "responseHeader": { "status":0 },
+                                    "response": { "numFound":1, "docs":[ { "id":fake.name } ] } })
+                if fake.status != 200:
+                    body = json.dumps({ "error": { "msg":"down", "code":fake.status } })
+                self.send_response(fake.status)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(body.encode('utf-8'))
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%s/solr' % self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def solrs():
+    gvi2pnx.REPLICAS.clear()
+    gvi2pnx.REPLICA_STATS.update(hedged=0, failover=0)
+    fakes = [FakeSolr('a'), FakeSolr('b')]
+    yield fakes
+    for fake in fakes:
+        fake.close()
+
+
+def search(fakes):
+    backend = gvi2pnx.SolrBackend([fake.url for fake in fakes], 5, 2)
+    return [doc['id'] for doc in backend.search('*:*')]
+
+
+def test_failover(solrs):
+    (a, b) = solrs
+    a.status = 503
+    assert search(solrs) == ['b']
+    assert gvi2pnx.REPLICA_STATS["failover"] == 1
+    assert gvi2pnx.get_replica(a.url).errors == 1
+
+
+def test_query_error_is_not_failed_over(solrs):
+    (a, b) = solrs
+    a.status = 400
+    with pytest.raises(gvi2pnx.SolrQueryError):
+        search(solrs)
+    assert b.hits == 0
+    assert gvi2pnx.get_replica(a.url).errors == 0
+
+
+def test_hedging(solrs, monkeypatch):
+    (a, b) = solrs
+    monkeypatch.setattr(gvi2pnx, 'HEDGE_DELAY', 0.1)
+    a.delay = 1.0
+    start = time.monotonic()
+    assert search(solrs) == ['b']
+    assert time.monotonic() - start < 0.8
+    assert gvi2pnx.REPLICA_STATS["hedged"] == 1
+
+
+def test_no_hedging_when_saturated(solrs, monkeypatch):
+    (a, b) = solrs
+    monkeypatch.setattr(gvi2pnx, 'HEDGE_DELAY', 0.1)
+    monkeypatch.setattr(gvi2pnx, 'HEDGE_MAX_INFLIGHT', 0)
+    a.delay = 0.3
+    assert search(solrs) == ['a']
+    assert b.hits == 0
+
+
+def test_failure_latency_is_recorded(solrs):
+    (a, b) = solrs
+    replica = gvi2pnx.get_replica(a.url)
+    replica.success(0.01)
+    replica.failure(5.0)
+    assert replica.latency.ewma > 0.5
+
+
+def test_breaker_and_recovery(solrs, monkeypatch):
+    (a, b) = solrs
+    monkeypatch.setattr(gvi2pnx, 'REPLICA_RETRY', 0.5)
+    a.status = 503
+    b.delay  = 0.05     # a bleibt die schnellere Replica und wird zuerst gefragt
+    for i in range(gvi2pnx.REPLICA_MIN_REQUESTS):
+        assert search(solrs) == ['b']
+    replica = gvi2pnx.get_replica(a.url)
+    assert not replica.available(time.monotonic())
+    hits = a.hits
+    assert search(solrs) == ['b']
+    assert a.hits == hits
+
+    a.status = 200
+    time.sleep(0.6)
+    assert search(solrs) == ['a']
+    assert replica.available(time.monotonic())
+
+
+def test_single_replica_is_never_disabled(solrs):
+    (a, b) = solrs
+    a.status = 503
+    for i in range(gvi2pnx.REPLICA_MIN_REQUESTS + 1):
+        with pytest.raises(gvi2pnx.pysolr.SolrError):
+            search([a])
+    a.status = 200
+    assert search([a]) == ['a']
+
+
+def test_concurrent_updates(solrs):
+    (a, b) = solrs
+    replica = gvi2pnx.get_replica(a.url)
+    errors  = []
+
+    def hammer(n):
+        try:
+            for i in range(2000):
+                if (i + n) % 3 == 0:
+                    replica.failure(0.01)
+                else:
+                    replica.success(0.01)
+                replica.hedge_delay()
+                replica.stats()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=hammer, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    assert replica.requests == 8 * 2000
+    assert replica.errors == len([1 for n in range(8) for i in range(2000) if (i + n) % 3 == 0])
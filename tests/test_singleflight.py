@@ -0,0 +1,148 @@
+# SingleFlight: Leader rechnet, Wartende bekommen sein Ergebnis oder seine
+# Exception; der Antwort-Cache ist gefuellt, bevor der Schluessel frei wird
+
+import os, sys, threading, time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gvi2pnx
+
+
+def run_followers(flight, key, fn, count):
+    # count Aufrufe von flight.do(key, fn) in Threads, die erst starten,
+    # wenn der Leader rechnet; liefert (Ergebnisse, Exceptions)
+    results = []
+    errors  = []
+
+    def follow():
+        try:
+            results.append(flight.do(key, fn))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=follow) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    return (threads, results, errors)
+
+
+def wait_for_followers(flight, key, count):
+    call = flight._calls[key]
+    deadline = time.monotonic() + 5
+    while call.followers < count and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert call.followers == count
+
+
+def test_followers_get_leader_result():
+    flight  = gvi2pnx.SingleFlight()
+    started = threading.Event()
+    go      = threading.Event()
+    calls   = []
+
+    def compute():
+        calls.append(1)
+        started.set()
+        go.wait(5)
+        return object()
+
+    (leader, results, errors) = run_followers(flight, 'k', compute, 1)
+    started.wait(5)
+    (threads, results2, errors2) = run_followers(flight, 'k', compute, 3)
+    wait_for_followers(flight, 'k', 3)
+    go.set()
+    for thread in leader + threads:
+        thread.join(5)
+    assert len(calls) == 1
+    assert len(set(map(id, results + results2))) == 1
+    assert errors + errors2 == []
+    assert flight.stats() == { "inflight":0, "leaders":1, "followers":3 }
+
+
+def test_followers_get_leader_exception():
+    flight  = gvi2pnx.SingleFlight()
+    started = threading.Event()
+    go      = threading.Event()
+    error   = ValueError('solr down')
+
+    def compute():
+        started.set()
+        go.wait(5)
+        raise error
+
+    (leader, results, errors) = run_followers(flight, 'k', compute, 1)
+    started.wait(5)
+    (threads, results2, errors2) = run_followers(flight, 'k', compute, 2)
+    wait_for_followers(flight, 'k', 2)
+    go.set()
+    for thread in leader + threads:
+        thread.join(5)
+    assert results + results2 == []
+    assert errors + errors2 == [error, error, error]
+    # der Schluessel ist wieder frei, die naechste Anfrage rechnet neu
+    assert flight.do('k', lambda: 42) == 42
+
+
+def test_release():
+    flight = gvi2pnx.SingleFlight()
+    (call, leader) = flight.begin('k')
+    assert leader
+    assert flight.release('k', call)
+    assert flight.stats()['inflight'] == 0
+
+    (call, leader) = flight.begin('k')
+    (follower, leader) = flight.begin('k')
+    assert follower is call and not leader
+    # mit Wartenden bleibt der Schluessel, der Leader muss finish() rufen
+    assert not flight.release('k', call)
+    flight.finish('k', call, 'done')
+    assert flight.wait(follower) == 'done'
+    assert flight.stats()['inflight'] == 0
+
+
+class RecordingFlight(gvi2pnx.SingleFlight):
+    # merkt sich bei finish(), ob die Antwort schon im Cache liegt
+    def __init__(self, cachekey):
+        gvi2pnx.SingleFlight.__init__(self)
+        self.cachekey = cachekey
+        self.cached   = []
+
+    def finish(self, key, call, result=None, error=None):
+        self.cached.append(gvi2pnx.RESPONSE_CACHE.contains(self.cachekey))
+        gvi2pnx.SingleFlight.finish(self, key, call, result, error)
+
+
+@pytest.fixture
+def fake_search(monkeypatch):
+    def search_json(config, _query, _facetquery, _sort, _from, _bulksize, deadline=None):
+        docs = [{ "id":str(i), "title":"x" * 100 } for i in range(20)]
+        return { "info":{ "total":20, "last":20, "first":1 }, "facets":{}, "docs":iter(docs) }
+    monkeypatch.setattr(gvi2pnx, 'search_json', search_json)
+    gvi2pnx.RESPONSE_CACHE.clear()
+    yield
+    gvi2pnx.RESPONSE_CACHE.clear()
+
+
+def test_cached_before_finish_buffered(fake_search, monkeypatch):
+    key    = ('finish-buffered',)
+    flight = RecordingFlight(key)
+    monkeypatch.setattr(gvi2pnx, 'SINGLEFLIGHT', flight)
+    config = gvi2pnx.Config()
+    flight.do(key + (None,), gvi2pnx.json_response, config, key, 'q', [], None, 0, 20)
+    assert flight.cached == [True]
+
+
+def test_cached_before_finish_streamed(fake_search, monkeypatch):
+    key    = ('finish-streamed',)
+    flight = RecordingFlight(key)
+    monkeypatch.setattr(gvi2pnx, 'SINGLEFLIGHT', flight)
+    config = gvi2pnx.Config()
+    entry = gvi2pnx.stream_json(config, key, key + (None,), 'q', [], None, 0, 20)
+    body  = b''.join(entry.body)
+    # finish() laeuft im STREAM_EXECUTOR nach dem letzten Teil
+    deadline = time.monotonic() + 5
+    while flight.cached == [] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert flight.cached == [True]
+    assert gvi2pnx.RESPONSE_CACHE.get(key).body == body
@@ -0,0 +1,179 @@
+# Kompakte /json Antworten: gestreamt, aus dem Antwort-Cache und mit gzip
+# muessen dieselben Bytes liefern wie dump_json der ganzen Antwort. Solr
+# ist eine http.server Attrappe ueber dem Korpus aus data/marcxml.jsonl.
+
+import gzip, json, os, sys, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+from flask import Flask
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gvi2pnx
+
+DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
+
+TOKEN = 'streamtest'
+
+
+def load_corpus():
+    # die Gruppenfelder fehlen im Korpus, jedes Dokument bekommt dieselben
+    with open(os.path.join(DATA, 'marcxml.jsonl'), encoding='utf-8') as f:
+        docs = [json.loads(line) for line in f]
+    for doc in docs:
+        doc.update(consortium=['DE-604'], institution_id=['DE-12'], language=['ger'])
+    return docs
+
+
+class CorpusSolr:
+    # jedes Dokument ist eine eigene Gruppe; beantwortet die Gruppen-,
+    # Facetten- und {!terms f=id} Anfragen von search_json
+    def __init__(self, docs):
+        self.docs = docs
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.answer(parse_qs(urlparse(self.path).query))
+
+            def do_POST(self):
+                size = int(self.headers.get('Content-Length', 0))
+                self.answer(parse_qs(self.rfile.read(size).decode('utf-8')))
+
+            def answer(self, params):
+                body = json.dumps(fake.select(params)).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:%s/solr' % self.server.server_address[1]
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def select(self, params):
+        def first(name, default):
+            return params.get(name, [default])[0]
+        fl   = first('fl', '*').split(',')
+        docs = [dict((k, v) for (k, v) in doc.items() if '*' in fl or k in fl) for doc in self.docs]
+        result = { "responseHeader": { "status":0 } }
+        query = first('q', '')
+        if query.startswith('{!terms f=id}'):
+            ids = query[len('{!terms f=id}'):].split(',')
+            docs = [doc for doc in docs if doc["id"] in ids]
+            result["response"] = { "numFound":len(docs), "start":0, "docs":docs }
+        elif first('group', 'false') == 'true':
+            start = int(first('start', '0'))
+            rows  = int(first('rows', '10'))
+            groups = [{ "groupValue":doc["id"], "doclist":{ "numFound":1, "start":0, "docs":[doc] } }
+                      for doc in docs[start:start+rows]]
+            result["grouped"] = { "test_matchkey_3": { "matches":len(docs), "groups":groups } }
+            result["stats"] = { "stats_fields": { "test_matchkey_3": { "cardinality":len(docs) } } }
+        else:
+            result["response"] = { "numFound":len(docs), "start":0, "docs":[] }
+            result["facet_counts"] = { "facet_fields": dict((name, []) for name in params.get('facet.field', [])),
+                                       "facet_queries": {} }
+        return result
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    solr = CorpusSolr(load_corpus())
+    ini = tmp_path / 'gvi2pnx.ini'
+    ini.write_text('[STREAMTEST]\nTOKEN = %s\nGVIURL = %s\n' % (TOKEN, solr.url))
+    monkeypatch.setattr(gvi2pnx, 'CONFIGFILE', str(ini))
+    gvi2pnx.CONFIG_CACHE.request_reload()
+    gvi2pnx.CONFIG_CACHE._checked = None
+    gvi2pnx.REPLICAS.clear()
+    app = Flask('test_streaming')
+    app.route('/json')(gvi2pnx.do_json)
+    yield app.test_client()
+    gvi2pnx.RESPONSE_CACHE.clear()
+    gvi2pnx.CONFIG_CACHE.request_reload()
+    gvi2pnx.CONFIG_CACHE._checked = None
+    solr.close()
+
+
+def expected(query='((Welt))', bulksize='10'):
+    # dieselbe Anfrage gepuffert (json_response), ohne Cache
+    config = gvi2pnx.get_config(TOKEN)
+    (_query, _facetquery, _sort, _from, _bulksize) = gvi2pnx.rewrite_parameters(
+        query, gvi2pnx.JSON_FILTERS + config.get_filters(), None, None, bulksize)
+    R = gvi2pnx.search_json(config, _query, _facetquery, _sort, _from, _bulksize)
+    R["docs"] = list(R["docs"])
+    return gvi2pnx.dump_json(R)
+
+
+def get(client, query='((Welt))', bulksize='10', **headers):
+    response = client.get('/json', query_string={ 'query':query, 'bulksize':bulksize, 'token':TOKEN },
+                          headers=headers)
+    assert response.status_code == 200
+    return response
+
+
+@pytest.mark.parametrize('docs', [
+    [],
+    [{ "id":"(DE-601)1", "title":["Straße", "été \U0001F600"] }],
+    [{ "id":"1", "n":[1, 2.5, None, True] }, { "id":"2", "nested":{ "a":{ "b":[] } } }],
+    ])
+def test_json_parts(docs):
+    R = { "info":{ "total":len(docs), "last":len(docs), "first":1 },
+          "facets":{ "language":[{ "name":"ger", "count":1 }] },
+          "docs":docs }
+    assert b''.join(gvi2pnx.json_parts(dict(R, docs=iter(docs)))) == gvi2pnx.dump_json(R)
+
+
+def test_streamed_body(client):
+    response = get(client)
+    assert response.is_streamed
+    assert response.data == expected()
+    R = json.loads(response.data)
+    assert R["info"] == { "total":16, "last":10, "first":1 }
+    assert len(R["docs"]) == 10
+
+
+def test_cached_body(client):
+    # der Stream endet erst, wenn der Eintrag im Cache liegt
+    streamed = get(client).data
+    assert gvi2pnx.RESPONSE_CACHE.stats()['entries'] == 1
+    hits = gvi2pnx.RESPONSE_CACHE.hits
+    assert get(client).data == streamed == expected()
+    assert gvi2pnx.RESPONSE_CACHE.hits == hits + 1
+
+
+def test_gzip_body(client):
+    plain = expected()
+    response = get(client, **{ 'Accept-Encoding':'gzip' })
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.data) == plain
+    # aus dem Cache: der mitgesammelte gzip Body
+    hits = gvi2pnx.RESPONSE_CACHE.hits
+    cached = get(client, **{ 'Accept-Encoding':'gzip' })
+    assert gvi2pnx.RESPONSE_CACHE.hits == hits + 1
+    assert cached.data == response.data
+
+
+def test_small_body_not_compressed(client, monkeypatch):
+    monkeypatch.setattr(gvi2pnx, 'COMPRESS_MIN_SIZE', 10**6)
+    response = get(client, **{ 'Accept-Encoding':'gzip' })
+    assert 'Content-Encoding' not in response.headers
+    assert response.data == expected()
+
+
+def test_not_cached(client, tmp_path):
+    ini = tmp_path / 'gvi2pnx.ini'
+    ini.write_text(ini.read_text() + 'CACHETTL = 0\n')
+    gvi2pnx.CONFIG_CACHE.request_reload()
+    gvi2pnx.CONFIG_CACHE._checked = None
+    assert get(client).data == expected()
+    assert gvi2pnx.RESPONSE_CACHE.stats()['entries'] == 0
+    assert gvi2pnx.SINGLEFLIGHT.stats()['inflight'] == 0
@@ -1,5 +1,5 @@
 from flask import Flask
-import os, logging
+import os, logging, queue, atexit
 import logging.handlers
 import locate, gvi2pnx, fidfl, fidfl2, test
 
@@ -14,14 +14,31 @@ except:
     
 LOG_FILENAME = '%s/primogvi/log/application.log' % home
 
+# LOG_LEVEL: DEBUG, INFO (Standard), WARNING ...; DEBUG Meldungen einzelner
+# Mandanten ueber DEBUG = True in gvi2pnx.ini
+LOG_LEVEL = getattr(logging, os.environ.get('LOG_LEVEL', 'INFO').upper(), logging.INFO)
+
 handler = logging.handlers.RotatingFileHandler(
               LOG_FILENAME, maxBytes=10000000, backupCount=20)
+handlers = [handler]
+
+# LOG_QUEUE=False: direkt in die Datei schreiben, sonst schreibt ein
+# eigener Thread (QueueListener) und die Anfrage wartet nicht auf die Platte
+if os.environ.get('LOG_QUEUE', 'True') != 'False':
+    log_queue = queue.SimpleQueue()
+    listener  = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)
+    handlers = [logging.handlers.QueueHandler(log_queue)]
 
 logging.basicConfig(
-    handlers = [handler],
-    level=logging.DEBUG,
+    handlers = handlers,
+    level=LOG_LEVEL,
     format='%(filename)s (line %(lineno)d) %(levelname)s %(asctime)s  %(message)s'
    )
+if LOG_LEVEL > logging.DEBUG:
+    # pysolr schreibt sonst jede Solr Anfrage als INFO
+    logging.getLogger('pysolr').setLevel(logging.WARNING)
 
 logging.info('----------------------')
 logging.info('Server Process started')
@@ -42,6 +59,18 @@ def do_plain():
 def do_json():
     return gvi2pnx.do_json()
 
+@app.route('/json/batch', methods=['POST'])
+def do_batch():
+    return gvi2pnx.do_batch()
+
+@app.route('/json/export')
+def do_export():
+    return gvi2pnx.do_export()
+
+@app.route('/stats')
+def do_stats():
+    return gvi2pnx.do_stats()
+
 
 
     